@@ -34,6 +34,7 @@ import traceback
 from pyerrors.errors import Error, is_error
 
 from ssm import misc
+from ssm.packagefile import read_member
 
 class Builder:
 
@@ -44,7 +45,7 @@ class Builder:
         self.dompath = dompath
         self.repourl = repourl
         try:
-            self.bcontrol = dict(json.load(tarfile.open(bssmpath).extractfile("bcontrol.json")))
+            self.bcontrol = dict(json.loads(read_member(bssmpath, "bcontrol.json")))
         except:
             self.bcontrol = {}
         self.platform = self.bcontrol.get("platform") or platform
@@ -23,6 +23,8 @@
 
 SSM_VERSION = "11.7"
 
+GENERATIONS_KEEP = 3
+
 IMPORTABLE_NAMES = ["bin", "include", "lib", "man", "share"]
 PUBLISHABLE_DIRS = ["bin", "etc/profile.d", "include", "lib", "man", "share"]
 SKELETON_COMPS = ["control", "pubdirs"]
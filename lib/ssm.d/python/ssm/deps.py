@@ -21,6 +21,7 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 # GPL--end
 
+from array import array
 import operator
 import re
 import string
@@ -38,197 +39,764 @@ sop2op = {
 }
 op2sop = dict([(v, k) for k, v in sop2op.items()])
 
-def uniq(l):
-    m = {}
-    ll = []
-    for x in l:
-        if x not in m:
-            m[x] = None
-            ll.append(x)
-    return ll
+# operator codes, as stored in the edge arrays; 0 is no operator
+opcodes = [None, operator.lt, operator.le, operator.eq, operator.ge, operator.gt, operator.ne]
+sop2opcode = dict([(sop, opcodes.index(op)) for sop, op in sop2op.items()])
 
-def version2tuple(s):
-    l = [int(v) if v.isdigit() else v for v in s.split(".")]
-    return tuple(l)
-
-class Provider:
-
-    def __init__(self, name, version=None):
-        self.name = name
-        self.version = version
-        self.versiont = version and version2tuple(version)
-        #print "Provider (%s, %s, %s)" % (name, version, self.versiont)
-
-    def __str__(self):
-        return "<Provider (%s, %s)>" % (self.name, self.version)
-
-    def __repr__(self):
-        return self.__str__()
-
-class Testable:
+# process-wide memos of parsed test expressions and version keys
+testspec2parsed = {}
+version2key = {}
 
-    def __init__(self, testspec):
-        self.testspec = testspec
-        self.__parse(testspec)
+versionpartcre = re.compile(r"[0-9]+|[^0-9]+")
 
-    def __str__(self):
-        return "<Testable (%s)>" % (self.testspec,)
-
-    def __repr__(self):
-        return self.__str__()
+# node kinds
+UNKNOWN = 0
+PACKAGE = 1
+VIRTUAL = 2
 
-    def __parse(self, testspec):
+def parse_testspec(testspec):
+    """Parse a test expression (e.g., "hdf5 >= 1.8") into the name,
+    operator code and version. Results are memoized.
+    """
+    parsed = testspec2parsed.get(testspec)
+    if parsed == None:
         try:
             d = testablecre.match(testspec).groupdict()
             if d["op"] == None:
-                self.name = d["name"]
-                self.op = None
-                self.version = None
-                self.versiont = None
-            elif len(d) == 3:
-                self.name = d["name"]
-                self.op = sop2op[d["op"]]
-                self.version = d["value"]
-                self.versiont = version2tuple(d["value"])
+                parsed = (d["name"], 0, None)
             else:
-                raise Exception()
+                parsed = (d["name"], sop2opcode[d["op"]], d["value"])
         except:
-            traceback.print_exc()
-            raise Exception("bad test expression")
-
-    def test(self, prov):
-        if prov:
-            if self.name == prov.name:
-                if not self.op:
-                    return True
-                return self.op(prov.versiont, self.versiont)
-        return False
-
-class Requirement(Testable):
-
-    def __init__(self, *args):
-        Testable.__init__(self, *args)
-        #print "Requirement testspec (%s)" % (self.testspec,)
-
-    def __str__(self):
-        return "<Requirement (%s)>" % (self.testspec,)
+            raise Exception("bad test expression (%s)" % (testspec,))
+        testspec2parsed[testspec] = parsed
+    return parsed
 
-class Conflict(Testable):
-
-    def __init__(self, *args):
-        Testable.__init__(self, *args)
-        #print "Conflict testspec (%s)" % (self.testspec,)
-
-    def __str__(self):
-        return "<Conflict (%s)>" % (self.testspec,)
-
-    def test(self, prov):
-        return not Testable.test(prov)
+def version2tuple(s):
+    """Return the comparison key of a version. Results are memoized.
+
+    Each dot-separated segment becomes a tuple of (0, int) and
+    (1, str) parts for its runs of digits and of other characters.
+    Keys of any two versions thus compare in a total, natural order
+    (e.g., 1.8.3 < 1.8.3b < 1.8.10) without comparing ints to strs.
+    """
+    key = version2key.get(s)
+    if key == None:
+        key = version2key[s] = tuple([tuple([part.isdigit() and (0, int(part)) or (1, part) \
+            for part in versionpartcre.findall(seg)]) for seg in s.split(".")])
+    return key
 
 class DependencyManager:
+    """Dependency graph of packages and the names they provide.
+
+    Names are interned to integer ids. Per-name data (kind, version
+    and version tuple) are held in lists indexed by id; requires are
+    held in flat edge arrays (source, destination, operator, version
+    tuple index) with the test expression kept for messages. Forward
+    and reverse adjacency, as offsets into arrays of edge and name
+    ids, are built when first needed after a change. Version tuples
+    are computed once and shared.
+    """
 
     def __init__(self):
-        self.name2provider = {}
-        self.name2requires = {}
-        self.name2provides = {}
-        self.name2conflicts = {}
-        self.name2requiredby = {}
+        self.names = []
+        self.name2id = {}
+        self.kinds = array("b")
+        self.versions = []
+        self.versionts = []
+        self.vtuples = []
+        self.version2vt = {}
+
+        # requires edges
+        self.esrcs = array("l")
+        self.edsts = array("l")
+        self.eops = array("b")
+        self.evts = array("l")
+        self.especs = []
+
+        # id -> [(dst, opcode, vt, testspec)]
+        self.conflicts = {}
+        # id -> [virtual id], virtual id -> id
+        self.provides = {}
+        self.vowners = {}
+
+        # adjacency, built on demand
+        self.foffs = None
+        self.fedges = None
+        self.roffs = None
+        self.rsrcs = None
+        # id -> frozenset of the ids requiring it, directly or
+        # indirectly; valid until the adjacency is rebuilt
+        self.rclosures = {}
+
+    def __add_edge(self, src, testspec):
+        name, opcode, version = parse_testspec(testspec)
+        self.esrcs.append(src)
+        self.edsts.append(self.__get_id(name))
+        self.eops.append(opcode)
+        self.evts.append(version == None and -1 or self.__get_vt(version))
+        self.especs.append(testspec)
+        self.foffs = None
+
+    def __clear(self, nid):
+        """Reset a name to unknown and drop its requires.
+        """
+        self.__compile()
+        for i in xrange(self.foffs[nid], self.foffs[nid+1]):
+            self.esrcs[self.fedges[i]] = -1
+        self.kinds[nid] = UNKNOWN
+        self.versions[nid] = None
+        self.versionts[nid] = None
+        self.foffs = None
+
+    def __compile(self):
+        """Drop removed edges and build the forward (by source) and
+        reverse (by destination, from packages only) adjacency.
+        """
+        if self.foffs != None:
+            return
+        esrcs = self.esrcs
+        if -1 in esrcs:
+            live = [e for e in xrange(len(esrcs)) if esrcs[e] >= 0]
+            self.esrcs = array("l", [esrcs[e] for e in live])
+            self.edsts = array("l", [self.edsts[e] for e in live])
+            self.eops = array("b", [self.eops[e] for e in live])
+            self.evts = array("l", [self.evts[e] for e in live])
+            self.especs = [self.especs[e] for e in live]
+            esrcs = self.esrcs
+        edsts = self.edsts
+        kinds = self.kinds
+        n = len(self.names)
+
+        # counting sorts keep edges in the order added
+        foffs = array("l", [0])*(n+1)
+        roffs = array("l", [0])*(n+1)
+        for e in xrange(len(esrcs)):
+            foffs[esrcs[e]+1] += 1
+            if kinds[esrcs[e]] == PACKAGE:
+                roffs[edsts[e]+1] += 1
+        for i in xrange(n):
+            foffs[i+1] += foffs[i]
+            roffs[i+1] += roffs[i]
+        fedges = array("l", [0])*foffs[n]
+        rsrcs = array("l", [0])*roffs[n]
+        fpos = foffs[:-1]
+        rpos = roffs[:-1]
+        for e in xrange(len(esrcs)):
+            src = esrcs[e]
+            fedges[fpos[src]] = e
+            fpos[src] += 1
+            if kinds[src] == PACKAGE:
+                dst = edsts[e]
+                rsrcs[rpos[dst]] = src
+                rpos[dst] += 1
+        self.foffs, self.fedges, self.roffs, self.rsrcs = foffs, fedges, roffs, rsrcs
+        self.rclosures = {}
+
+    def __get_id(self, name):
+        nid = self.name2id.get(name)
+        if nid == None:
+            nid = self.name2id[name] = len(self.names)
+            self.names.append(name)
+            self.kinds.append(UNKNOWN)
+            self.versions.append(None)
+            self.versionts.append(None)
+            self.foffs = None
+        return nid
+
+    def __get_vt(self, version):
+        vt = self.version2vt.get(version)
+        if vt == None:
+            vt = self.version2vt[version] = len(self.vtuples)
+            self.vtuples.append(version2tuple(version))
+        return vt
+
+    def __str_provider(self, nid):
+        return "<Provider (%s, %s)>" % (self.names[nid], self.versions[nid])
+
+    def __test(self, nid, opcode, vt):
+        if not opcode:
+            return True
+        if self.versionts[nid] == None:
+            # an unversioned provide satisfies no version test
+            return False
+        return opcodes[opcode](self.versionts[nid], self.vtuples[vt])
+
+    def __set_vowner(self, vid, nid):
+        """Make nid the provider of the virtual name vid. The latest
+        provider wins, even over a package of that name.
+        """
+        if self.kinds[vid] != UNKNOWN:
+            self.__clear(vid)
+        self.kinds[vid] = VIRTUAL
+        self.vowners[vid] = nid
+        self.__add_edge(vid, self.names[nid])
 
     def add(self, name, version, requires=None, provides=None, conflicts=None):
-        if name in self.name2provider:
-            prov = self.name2provider[name]
-            raise Exception("duplicate (%s) found with provider (%s)" % (name, prov))
-        prov = Provider(name, version)
-        self.name2provider[name] = prov
+        nid = self.__get_id(name)
+        if self.kinds[nid] != UNKNOWN:
+            raise Exception("duplicate (%s) found with provider (%s)" % (name, self.__str_provider(nid)))
+        self.kinds[nid] = PACKAGE
+        self.versions[nid] = version
+        self.versionts[nid] = version and self.vtuples[self.__get_vt(version)]
+        self.foffs = None
 
         if requires:
-            requires = map(string.strip, requires.split(","))
-            self.name2requires[name] = [Requirement(testspec) for testspec in requires]
-            for require in self.name2requires[name]:
-                #print "name (%s) require (%s)" % (name, require)
-                l = self.name2requiredby.setdefault(require.name, [])
-                l.append(name)
+            for testspec in map(string.strip, requires.split(",")):
+                self.__add_edge(nid, testspec)
 
         if provides:
-            l = self.name2provides[name] = []
-            provides = map(string.strip, provides.split(","))
-            for pprov in provides:
-                pprov = Provider(pprov)
-                l.append(pprov)
-                if 1 or pprov.name not in self.name2provider:
-                    self.name2provider[pprov.name] = pprov
-                    self.name2requires[pprov.name] = [Requirement(prov.name)]
-                else:
-                    dprov = self.name2provider[pprov.name]
-                    raise Exception("duplicate provider (%s) found" % (dprov,))
-                    
+            l = self.provides[nid] = []
+            for pname in map(string.strip, provides.split(",")):
+                vid = self.__get_id(pname)
+                if vid == nid:
+                    continue
+                self.__set_vowner(vid, nid)
+                l.append(vid)
+
         if conflicts:
-            conflicts = map(string.strip, conflicts.split(","))
-            self.name2conflicts[name] = [Conflict(testspec) for testspec in conflicts]
+            l = self.conflicts[nid] = []
+            for testspec in map(string.strip, conflicts.split(",")):
+                cname, opcode, cversion = parse_testspec(testspec)
+                l.append((self.__get_id(cname), opcode, cversion and self.__get_vt(cversion), testspec))
+
+    def remove(self, name):
+        """Remove a name added by add(), with its requires, provides
+        and conflicts. Names requiring it are not removed.
+        """
+        nid = self.name2id.get(name)
+        if nid == None or self.kinds[nid] != PACKAGE:
+            return
+        self.__clear(nid)
+        for vid in self.provides.pop(nid, []):
+            if self.vowners.get(vid) == nid:
+                del self.vowners[vid]
+                self.__clear(vid)
+        self.conflicts.pop(nid, None)
 
     def verify(self):
         pass
 
+    def get_graph(self):
+        """Return the graph as a dict of plain data, which can be
+        given to set_graph().
+        """
+        self.__compile()
+        names = self.names
+        providers = {}
+        requires = {}
+        for nid in xrange(len(names)):
+            if self.kinds[nid] == PACKAGE:
+                providers[names[nid]] = self.versions[nid]
+                if self.foffs[nid] != self.foffs[nid+1]:
+                    requires[names[nid]] = [self.especs[self.fedges[i]] for i in xrange(self.foffs[nid], self.foffs[nid+1])]
+        return {
+            "providers": providers,
+            "requires": requires,
+            "provides": dict([(names[nid], [names[vid] for vid in vids]) for nid, vids in self.provides.items()]),
+            "conflicts": dict([(names[nid], [conf[3] for conf in confs]) for nid, confs in self.conflicts.items()]),
+            "vowners": dict([(names[vid], names[nid]) for vid, nid in self.vowners.items()]),
+        }
+
     def get_names(self):
-        return self.name2provider.keys()
+        return [self.names[nid] for nid in xrange(len(self.names)) if self.kinds[nid] != UNKNOWN]
+
+    def __get_requiredby_ids(self, nid):
+        """Return the ids of the packages directly requiring nid or a
+        name it provides.
+        """
+        roffs, rsrcs = self.roffs, self.rsrcs
+        sids = [rsrcs[i] for i in xrange(roffs[nid], roffs[nid+1])]
+        for vid in self.provides.get(nid, []):
+            if self.vowners.get(vid) == nid:
+                sids.extend([rsrcs[i] for i in xrange(roffs[vid], roffs[vid+1])])
+        return sids
+
+    def __get_closure(self, nid):
+        """Return the ids of the packages requiring nid, directly or
+        indirectly. Closures are memoized, and those already known are
+        reused rather than walked again.
+        """
+        closure = self.rclosures.get(nid)
+        if closure != None:
+            return closure
+        rclosures = self.rclosures
+        seen = set()
+        todo = [nid]
+        while todo:
+            for sid in self.__get_requiredby_ids(todo.pop()):
+                if sid in seen:
+                    continue
+                seen.add(sid)
+                closure = rclosures.get(sid)
+                if closure != None:
+                    seen.update(closure)
+                else:
+                    todo.append(sid)
+        closure = rclosures[nid] = frozenset(seen)
+        return closure
 
     def get_requiredby(self, names, indirect=False):
-        """Get list of names required by given list. An indirect
-        search will return directly and indirectly required names.
+        """Get set of names requiring the given list (through the
+        names they provide too). An indirect search will return the
+        given names with the directly and indirectly requiring names.
         """
+        self.__compile()
         if indirect:
-            seen = set()
-            names = set(names)
-            while names:
-                name = names.pop()
-                seen.add(name)
-                _names = self.name2requiredby.get(name, [])
-                for name in _names:
-                    if name not in seen:
-                        names.add(name)
-            names = seen
+            sids = set()
+            for name in names:
+                nid = self.name2id.get(name)
+                if nid != None:
+                    sids.update(self.__get_closure(nid))
+            _names = set(names)
         else:
-            names = set([names for names in self.name2requiredby.get(name)])
-        return names
-
-    def _generate(self, name):
+            sids = set()
+            for name in names:
+                nid = self.name2id.get(name)
+                if nid != None:
+                    sids.update(self.__get_requiredby_ids(nid))
+            _names = set()
+        _names.update([self.names[sid] for sid in sids])
+        return _names
+
+    def get_version(self, name):
+        nid = self.name2id.get(name)
+        return nid != None and self.versions[nid] or None
+
+    def set_graph(self, d):
+        """Replace the graph with one from get_graph().
+        """
+        self.__init__()
+        requires = d["requires"]
+        provides = d["provides"]
+        conflicts = d["conflicts"]
+        for name, version in d["providers"].items():
+            self.add(name, version,
+                ", ".join(requires.get(name, [])) or None,
+                ", ".join(provides.get(name, [])) or None,
+                ", ".join(conflicts.get(name, [])) or None)
+        # providers are added in no particular order, so restore
+        # which one won each virtual name
+        name2id = self.name2id
+        for vname, name in d.get("vowners", {}).items():
+            vid, nid = name2id.get(vname), name2id.get(name)
+            if vid != None and nid != None and self.vowners.get(vid) != nid:
+                self.__set_vowner(vid, nid)
+
+    def _generate(self, nid):
+        """Check a name and return the ids of the names it requires.
+        """
+        names = self.names
+        kinds = self.kinds
+        if kinds[nid] == UNKNOWN:
+            raise Exception("cannot find name (%s)" % (names[nid],))
+        for cid, opcode, vt, testspec in self.conflicts.get(nid, []):
+            if kinds[cid] != UNKNOWN and self.__test(cid, opcode, vt):
+                raise Exception("conflict (%s) found for provide (%s)" % (testspec, self.__str_provider(cid)))
         deps = []
-        prov = self.name2provider[name]
-        if not prov:
-            raise Exception("cannot find name (%s)" % (name,))
-        confs = self.name2conflicts.get(name) or []
-        for conf in confs:
-            tprov = self.name2provider.get(conf.name)
-            if conf.test(tprov):
-                    raise Exception("conflict (%s) found for provide (%s)" % (conf, tprov))
-        reqs = self.name2requires.get(name) or []
-        for req in reqs:
-            tprov = self.name2provider.get(req.name)
-            #print "prov (%s) req (%s) tprov (%s)" % (prov, req, tprov)
-            if not tprov:
-                raise Exception("cannot find/missing name (%s)" % (req.name,))
-            if not req.test(tprov):
-                raise Exception("require (%s) does not satisfy provide (%s)" % (req, tprov.name))
-            deps.append(req.name)
+        for i in xrange(self.foffs[nid], self.foffs[nid+1]):
+            e = self.fedges[i]
+            dst = self.edsts[e]
+            if kinds[dst] == UNKNOWN:
+                raise Exception("cannot find/missing name (%s)" % (names[dst],))
+            if not self.__test(dst, self.eops[e], self.evts[e]):
+                raise Exception("require (%s) does not satisfy provide (%s)" % (self.especs[e], names[dst]))
+            deps.append(dst)
         return deps
 
-    def generate(self, names):
+    def generate(self, names=None):
         """Generate dependency list of named packages (or all if not
-        specified).
+        specified), dependencies first.
+
+        The graph is walked depth-first, without recursion, and each
+        name is checked and visited once. The order is stable: names
+        and requires are taken in the order given. A dependency cycle
+        raises an exception giving the cycle.
         """
-        deps = names
-        newdeps = deps[:]
-        while newdeps:
-            _deps = []
-            for newname in newdeps:
-                _deps.extend(self._generate(newname))
-            deps.extend(_deps)
-            newdeps = _deps
-        return uniq(reversed(deps))
+        self.__compile()
+        if names == None:
+            names = sorted(self.get_names())
+        order = []
+        done = set()
+        for name in names:
+            nid = self.name2id.get(name)
+            if nid == None:
+                raise Exception("cannot find name (%s)" % (name,))
+            if nid in done:
+                continue
+            # path from name to the current node, and iterators over
+            # the requires still to visit for each node on it
+            path = [nid]
+            onpath = set(path)
+            stack = [iter(self._generate(nid))]
+            while stack:
+                for dep in stack[-1]:
+                    if dep in done:
+                        continue
+                    if dep in onpath:
+                        cycle = path[path.index(dep):]+[dep]
+                        raise Exception("dependency cycle found (%s)" % (" -> ".join([self.names[x] for x in cycle]),))
+                    path.append(dep)
+                    onpath.add(dep)
+                    stack.append(iter(self._generate(dep)))
+                    break
+                else:
+                    stack.pop()
+                    dep = path.pop()
+                    onpath.discard(dep)
+                    done.add(dep)
+                    order.append(self.names[dep])
+        return order
+
+class Candidate(object):
+    """One version of a package considered by VersionSolver.
+    """
+
+    __slots__ = ["name", "version", "key", "requires", "provides", "conflicts"]
+
+    def __init__(self, name, version, requires=None, provides=None, conflicts=None):
+        self.name = name
+        self.version = version
+        self.key = version2tuple(version)
+        self.requires = requires and map(parse_testspec, map(string.strip, requires.split(","))) or []
+        self.provides = provides and map(string.strip, provides.split(",")) or []
+        self.conflicts = conflicts and map(parse_testspec, map(string.strip, conflicts.split(","))) or []
+
+    def __str__(self):
+        return "<Candidate (%s, %s)>" % (self.name, self.version)
+
+    __repr__ = __str__
+
+def test_key(key, opcode, version):
+    """Test a version key against an operator code and version.
+    """
+    if not opcode:
+        return True
+    if key == None:
+        return False
+    return opcodes[opcode](key, version2tuple(version))
+
+class VersionSolver:
+    """Choose one version for each package needed by a set of names,
+    from candidate versions, such that all requires are satisfied and
+    there are no conflicts. Requires, provides and conflicts are as
+    for DependencyManager; a provided name satisfies unversioned
+    requires only.
+
+    Candidates which cannot be part of any solution (excluded by a
+    versioned root require, or with a require no other candidate can
+    satisfy) are pruned first. The search is then depth-first over the
+    requires, newest versions first. Candidates are checked against the versions already
+    chosen before being tried. On failure, the decisions responsible
+    are tracked and the search jumps back to the latest of them
+    (conflict-directed backjumping), rather than trying the
+    alternatives of unrelated decisions.
+    """
+
+    def __init__(self):
+        self.name2cands = {}
+        self.provname2cands = {}
+        self.tries = 0
+
+    def add(self, name, version, requires=None, provides=None, conflicts=None):
+        cand = Candidate(name, version, requires, provides, conflicts)
+        self.name2cands.setdefault(name, []).append(cand)
+        for provname in cand.provides:
+            self.provname2cands.setdefault(provname, []).append(cand)
+
+    def __check(self, cand, chosen, name2frame, conflictedby):
+        """Return the frames of the chosen candidates which exclude
+        cand, or an empty set.
+        """
+        frames = set()
+        other = chosen.get(cand.name)
+        if other != None and other is not cand:
+            frames.add(name2frame[cand.name])
+        for name, opcode, version in cand.requires:
+            other = chosen.get(name)
+            if other != None and not test_key(other.key, opcode, version):
+                frames.add(name2frame[name])
+        for name, opcode, version in cand.conflicts:
+            other = chosen.get(name)
+            if other != None and test_key(other.key, opcode, version):
+                frames.add(name2frame[name])
+        for opcode, version, frame in conflictedby.get(cand.name, []):
+            if test_key(cand.key, opcode, version):
+                frames.add(frame)
+        return frames
+
+    def __satisfied(self, require, name2cands, provname2cands, live):
+        name, opcode, version = require
+        for cand in name2cands.get(name, []):
+            if cand in live and test_key(cand.key, opcode, version):
+                return True
+        if not opcode:
+            for cand in provname2cands.get(name, []):
+                if cand in live:
+                    return True
+        return False
+
+    def __prune(self, roots):
+        """Return name -> candidates and provided name -> candidates,
+        without the candidates excluded by versioned root requires
+        and, transitively, the candidates with a require that no
+        remaining candidate satisfies.
+        """
+        live = set()
+        for cands in self.name2cands.values():
+            live.update(cands)
+        for name, opcode, version in roots:
+            for cand in self.name2cands.get(name, []):
+                if not test_key(cand.key, opcode, version):
+                    live.discard(cand)
+
+        requiredby = {}
+        for cand in live:
+            for require in cand.requires:
+                requiredby.setdefault(require[0], []).append(cand)
+
+        work = list(live)
+        while work:
+            cand = work.pop()
+            if cand not in live:
+                continue
+            for require in cand.requires:
+                if not self.__satisfied(require, self.name2cands, self.provname2cands, live):
+                    live.discard(cand)
+                    for name in [cand.name]+cand.provides:
+                        work.extend(requiredby.get(name, []))
+                    break
+
+        name2cands = {}
+        for name, cands in self.name2cands.items():
+            name2cands[name] = [cand for cand in cands if cand in live]
+        provname2cands = {}
+        for name, cands in self.provname2cands.items():
+            provname2cands[name] = [cand for cand in cands if cand in live]
+        return name2cands, provname2cands
+
+    def solve(self, names):
+        """Return a map of package name to chosen version satisfying
+        the names (test expressions are allowed, e.g., "hdf5 >= 1.8").
+        Raise an exception if there is no solution.
+        """
+        for cands in self.name2cands.values():
+            cands.sort(key=lambda cand: cand.key, reverse=True)
+
+        roots = map(parse_testspec, names)
+        name2cands, provname2cands = self.__prune(roots)
+
+        # requires to satisfy, in order: (name, opcode, version, frame)
+        agenda = [root+(None,) for root in roots]
+        pos = 0
+        # name -> chosen candidate, and frame (index) of the choice
+        chosen = {}
+        name2frame = {}
+        provided = {}
+        # name -> conflicts of the chosen candidates: (opcode,
+        # version, frame)
+        conflictedby = {}
+        # per frame: [options, next index, conflict frames, agenda
+        # length, agenda position]
+        frames = []
+        self.tries = 0
+
+        conflict = None
+        lastname = None
+        while True:
+            if conflict == None:
+                if pos == len(agenda):
+                    return dict([(name, cand.version) for name, cand in chosen.items()])
+                name, opcode, version, origin = agenda[pos]
+                cand = chosen.get(name)
+                if cand != None:
+                    if test_key(cand.key, opcode, version):
+                        pos += 1
+                        continue
+                    conflict = set([name2frame[name], origin])
+                    continue
+                elif name in provided and not opcode:
+                    pos += 1
+                    continue
+                else:
+                    # new decision: gather candidates not excluded by
+                    # the choices made so far
+                    options = []
+                    causes = set([origin])
+                    for cand in name2cands.get(name, [])+provname2cands.get(name, []):
+                        if cand.name == name and not test_key(cand.key, opcode, version):
+                            continue
+                        if cand.name != name and opcode:
+                            continue
+                        excluders = self.__check(cand, chosen, name2frame, conflictedby)
+                        if excluders:
+                            causes.update(excluders)
+                        else:
+                            options.append(cand)
+                    if not options:
+                        lastname = name
+                    frames.append([options, 0, causes, len(agenda), pos])
+            else:
+                # jump back to the latest decision responsible
+                conflict.discard(None)
+                while frames and len(frames)-1 not in conflict:
+                    self.__undo(frames.pop(), chosen, name2frame, provided, conflictedby, agenda)
+                if not frames:
+                    raise Exception("no solution found for (%s); last unsatisfied (%s)" % (", ".join(names), lastname))
+                frame = frames[-1]
+                self.__undo(frame, chosen, name2frame, provided, conflictedby, agenda)
+                frame[2].update(conflict)
+                frame[2].discard(len(frames)-1)
+                conflict = None
+
+            # try the next option of the latest decision
+            frame = frames[-1]
+            options, i, causes, agendalen, pos = frame
+            if i == len(options):
+                frames.pop()
+                conflict = set(causes)
+                continue
+            frame[1] = i+1
+            cand = options[i]
+            self.tries += 1
+            chosen[cand.name] = cand
+            name2frame[cand.name] = len(frames)-1
+            for provname in cand.provides:
+                provided.setdefault(provname, cand)
+            for name, opcode, version in cand.conflicts:
+                conflictedby.setdefault(name, []).append((opcode, version, len(frames)-1))
+            for require in cand.requires:
+                agenda.append(require+(len(frames)-1,))
+            pos += 1
+
+    def __undo(self, frame, chosen, name2frame, provided, conflictedby, agenda):
+        options, i, causes, agendalen, pos = frame
+        if i:
+            cand = options[i-1]
+            chosen.pop(cand.name, None)
+            name2frame.pop(cand.name, None)
+            for provname in cand.provides:
+                if provided.get(provname) is cand:
+                    del provided[provname]
+            for name, opcode, version in cand.conflicts:
+                conflictedby[name].pop()
+        del agenda[agendalen:]
+
+def benchmark(sizes):
+    """Time building and resolving synthetic graphs: a chain, a
+    layered graph where each name requires several names of the layer
+    below, and a graph with a cycle.
+    """
+    import random
+    import resource
+    import time
+
+    def build(size, fn):
+        dm = DependencyManager()
+        t0 = time.time()
+        for i in xrange(size):
+            dm.add(*fn(i))
+        return dm, time.time()-t0
+
+    def run(label, dm, tadd, names):
+        t0 = time.time()
+        try:
+            n = len(dm.generate(names))
+        except Exception as e:
+            n = str(e)[:40]
+        print "%-8s %7s nodes  add %7.3fs  generate %7.3fs  %s" % (label, len(dm.get_names()), tadd, time.time()-t0, n)
+
+    rand = random.Random(0)
+    width = 100
+    for size in sizes:
+        dm, tadd = build(size, lambda i: ("n%s" % i, "1.0", i and "n%s >= 1.0" % (i-1,) or None))
+        run("chain", dm, tadd, ["n%s" % (size-1,)])
+
+        def layered(i):
+            layer = i/width
+            if layer == 0:
+                return "n%s" % i, "1.%s" % (i%10,), None
+            requires = ", ".join(["n%s >= 1.0" % ((layer-1)*width+rand.randrange(width),) for _ in xrange(4)])
+            return "n%s" % i, "1.%s" % (i%10,), requires
+        dm, tadd = build(size, layered)
+        run("layered", dm, tadd, ["n%s" % i for i in xrange(size-width, size)])
+        # dependents of each bottom layer name, then again memoized
+        for label in ["closures", "memoized"]:
+            t0 = time.time()
+            n = sum([len(dm.get_requiredby(["n%s" % i], True)) for i in xrange(width)])
+            print "%-8s %7s nodes  requiredby %7.3fs  %s" % (label, size, time.time()-t0, n)
+
+        dm, tadd = build(size, lambda i: ("c%s" % i, "1.0", "c%s" % ((i-1)%size,)))
+        run("cycle", dm, tadd, ["c0"])
+    versions = ["%s.%s.%s%s" % (rand.randrange(3), rand.randrange(20), rand.randrange(20), rand.choice(["", "b", "rc1"])) \
+        for _ in xrange(100000)]
+    for label in ["sort", "sort again"]:
+        t0 = time.time()
+        versions.sort(key=version2tuple)
+        print "%-8s %7s versions %7.3fs" % (label, len(versions), time.time()-t0)
+    print "maxrss %s KB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,)
+
+def benchmark_solver():
+    """Time VersionSolver on synthetic repositories.
+    """
+    import random
+    import time
+
+    def run(label, solver, names):
+        t0 = time.time()
+        try:
+            n = "%s chosen" % (len(solver.solve(names)),)
+        except Exception as e:
+            n = str(e)[:40]
+        print "%-10s %6s versions  %8.3fs  %7s tries  %s" % (label, sum(map(len, solver.name2cands.values())), time.time()-t0, solver.tries, n)
+
+    rand = random.Random(0)
+
+    # many packages and versions, loose requires: newest versions win
+    solver = VersionSolver()
+    for i in xrange(2000):
+        for j in xrange(5):
+            requires = ", ".join(["n%s >= 1.%s" % (rand.randrange(i), rand.randrange(3)) for _ in xrange(min(i, 3))])
+            solver.add("n%s" % i, "1.%s" % j, requires or None)
+    run("newest", solver, ["n%s" % i for i in xrange(1950, 2000)])
+
+    # as above, with a root pin forcing older versions of dependents
+    run("pinned", solver, ["n0 < 1.3"]+["n%s" % i for i in xrange(1950, 2000)])
+
+    # a late require fails for all but the oldest version; unrelated
+    # earlier choices (30 names of 10 versions) are not retried
+    solver = VersionSolver()
+    for i in xrange(30):
+        for j in xrange(10):
+            solver.add("b%s" % i, "1.%s" % j)
+    for j in xrange(10):
+        solver.add("c", "1.%s" % j, j and "d >= 1.%s" % j or None)
+    solver.add("d", "1.0")
+    run("backjump", solver, ["b%s" % i for i in xrange(30)]+["c"])
+
+    # no solution: proven without enumerating the earlier choices
+    solver.add("e", "1.0", "d >= 2.0")
+    run("unsat", solver, ["b%s" % i for i in xrange(30)]+["c", "e"])
+
+    # virtual provides with conflicts between providers
+    solver = VersionSolver()
+    for i in xrange(50):
+        for j in xrange(4):
+            solver.add("mpi%s" % i, "%s.0" % (j+1), None, "mpi", i and "mpi0" or None)
+    for i in xrange(500):
+        for j in xrange(4):
+            solver.add("app%s" % i, "1.%s" % j, "mpi, app%s" % rand.randrange(max(i, 1)) if i else "mpi")
+    run("virtual", solver, ["app%s" % i for i in xrange(450, 500)])
 
 if __name__ == "__main__":
     import sys
 
+    if sys.argv[1:2] == ["--benchmark"]:
+        benchmark(map(int, sys.argv[2:]) or [10000, 100000])
+        sys.exit(0)
+    elif sys.argv[1:2] == ["--benchmark-solver"]:
+        benchmark_solver()
+        sys.exit(0)
+
     if 0:
         try:
             dm = DependencyManager()
@@ -265,9 +833,9 @@ if __name__ == "__main__":
                 bs.get("conflicts", None))
             print "-----"
         print "====="
-        print dm.name2provider
+        print dm.get_names()
         print "====="
         xtargetnames = dm.generate(targetnames)
         print xtargetnames
-        providers = map(dm.name2provider.get, xtargetnames)
-        print providers
+        versions = map(dm.get_version, xtargetnames)
+        print versions
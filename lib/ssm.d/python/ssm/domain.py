@@ -21,8 +21,10 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 # GPL--end
 
+import json
 import os
 import os.path
+import subprocess
 import sys
 import tarfile
 import traceback
@@ -31,8 +33,12 @@ from pyerrors.errors import Error, is_error
 
 from ssm import constants
 from ssm import globls
+from ssm.control import Control
 from ssm.deps import DependencyManager
+from ssm.index import ClosureIndex, ControlIndex, DependencyIndex, InventoryIndex, OwnerIndex, get_mtime, get_stamp
+from ssm.jsonfile import JsonFile
 from ssm import misc
+from ssm.manifest import PublishManifest
 from ssm.meta import Meta
 from ssm.misc import gets, oswalk1, puts
 from ssm.package import Package
@@ -49,30 +55,568 @@ class Domain:
         self.installed_path = self.joinpath("etc/ssm.d/installed")
         self.published_path = self.joinpath("etc/ssm.d/published")
         self.meta_path = self.joinpath("etc/ssm.d/meta.json")
+        self.index_path = self.joinpath("etc/ssm.d/index.json")
+        self.controls_path = self.joinpath("etc/ssm.d/controls.json")
+        self.depgraphs_path = self.joinpath("etc/ssm.d/depgraphs")
+        self.manifests_path = self.joinpath("etc/ssm.d/manifests")
+        self.owners_path = self.joinpath("etc/ssm.d/owners")
+        self.generations_path = self.joinpath("etc/ssm.d/generations")
 
         self.legacy = None
+        # control index, loaded on first use
+        self.control_index = None
+        # inventory index, kept while current
+        self.index = None
+        # platform -> staging generation path
+        self.staging = {}
+        # platform -> metadata changes held back while staging
+        self.pending = {}
 
-    def __create_depmgr(self, platforms):
+    def __create_depmgr(self, platforms, excludeshorts=None):
+        """Return a dependency manager of the published packages, less
+        those excluded. For a single platform, the saved dependency
+        graph is used (see __get_depgraph()).
+        """
+        if len(platforms) == 1:
+            dm = self.__get_depgraph(platforms[0])
+            for short in excludeshorts or []:
+                # the graph is keyed by control name
+                name = self.get_index().get_published_short(platforms[0], short)
+                if name:
+                    pkg = Package(os.path.join(self.published_path, platforms[0], name))
+                    dm.remove(self.get_package_control(pkg).get("name"))
+            return dm
+        return self.__scan_depmgr(platforms, excludeshorts)
+
+    def __scan_depmgr(self, platforms, excludeshorts=None):
+        """Return a dependency manager loaded with the controls of the
+        published packages (see get_package_control()).
+        """
         dm = DependencyManager()
         for pkg in self.get_published_packages(platforms):
-            control = pkg.get_control()
+            if excludeshorts and pkg.short in excludeshorts:
+                continue
+            control = self.get_package_control(pkg)
             dm.add(control.get("name"),
                 control.get("version"),
                 control.get("requires"),
                 control.get("provides"),
                 control.get("conflicts"))
+        self.__put_control_index()
+        return dm
+
+    def __abort_generation(self, platform):
+        """Discard the staging generation and the metadata changes
+        held back for it.
+        """
+        path = self.staging.pop(platform)
+        self.pending.pop(platform)
+        misc.rmtree(path)
+
+    def __begin_generation(self, platform):
+        """Create the next generation of the platform tree, as a copy
+        of the current one, and stage it. Changes to the manifests,
+        owner index and published package links of the platform are
+        held back until the generation is committed.
+
+        Links are copied as hard links to the same symlinks so that
+        unchanged links are shared between generations. If the oldest
+        generation is due to be pruned, it is reused instead: only
+        the directories changed since (as recorded for each
+        generation) are copied again, and it is lost if the operation
+        fails. This requires the current tree to be unchanged since it
+        was committed, as known from the owner index.
+        """
+        generations = self.get_generations(platform)
+        current = self.get_current_generation(platform)
+        generation = max(generations)+1
+        path = os.path.join(self.generations_path, platform, str(generation))
+        curpath = os.path.join(self.generations_path, platform, str(current))
+        reldirnames = None
+        if len(generations) >= self.__get_generations_keep() and generations[0] != current \
+            and self.__load_owner_index(platform) != None:
+            reldirnames = self.__get_changed_dirs_since(platform, generations[0], current)
+        if reldirnames == None:
+            misc.copylinks(curpath, path)
+        else:
+            oldpath = os.path.join(self.generations_path, platform, str(generations[0]))
+            if os.path.exists(oldpath+".meta"):
+                misc.rmtree(oldpath+".meta")
+            misc.rename(oldpath, path)
+            misc.synclinks(curpath, path, reldirnames)
+        self.staging[platform] = path
+        self.pending[platform] = {
+            "manifests": {},
+            "owners": None,
+            "published": [],
+        }
+
+    def __commit_generation(self, platform):
+        """Make the staging generation the current one and apply the
+        metadata changes held back for it. The metadata is then saved
+        for the generation, with the directories changed, and old
+        generations are pruned.
+        """
+        reldirnames = self.__get_changed_dirs(platform)
+        parent = self.get_current_generation(platform)
+        owners = self.get_owner_index(platform)
+        path = self.staging.pop(platform)
+        pending = self.pending.pop(platform)
+        generation = int(os.path.basename(path))
+        misc.relink(self.__get_generation_relpath(platform, generation), self.joinpath(platform))
+
+        # the tree is a new copy, stamped anew
+        self.__put_owner_index(platform, owners, reldirnames, True)
+        for name, manifest in pending["manifests"].items():
+            if manifest:
+                self.__put_manifest(name, platform, manifest)
+            else:
+                self.__unset_manifest(name, platform)
+        for pkg, published in pending["published"]:
+            if published:
+                self.__set_published(pkg, platform)
+            else:
+                self.__unset_published(pkg, platform)
+        self.__snapshot_generation_meta(platform, generation, parent, reldirnames)
+        self.__prune_generations(platform)
+
+    def __get_changed_dirs_since(self, platform, oldgeneration, generation):
+        """Return the directories of the platform tree changed from an
+        older generation to a later one descending from it, or None if
+        not known (see __snapshot_generation_meta()).
+        """
+        reldirnames = set()
+        while generation != oldgeneration:
+            changes = JsonFile()
+            changes.load(os.path.join(self.generations_path, platform, "%s.meta" % (generation,), "changes.json"))
+            generation = changes.get("parent")
+            if generation == None or generation < oldgeneration:
+                return None
+            reldirnames.update(changes.get("dirs"))
+        return reldirnames
+
+    def __get_generation_relpath(self, platform, generation):
+        return os.path.join("etc/ssm.d/generations", platform, str(generation))
+
+    def __get_generations_keep(self):
+        return int(self.get_meta().get("generations") or constants.GENERATIONS_KEEP)
+
+    def __prune_generations(self, platform):
+        keep = self.__get_generations_keep()
+        current = self.get_current_generation(platform)
+        for generation in self.get_generations(platform)[:-keep]:
+            if generation != current:
+                path = os.path.join(self.generations_path, platform, str(generation))
+                misc.rmtree(path)
+                if os.path.exists(path+".meta"):
+                    misc.rmtree(path+".meta")
+
+    def __restore_generation_meta(self, platform, generation):
+        """Restore the manifests, owner index and published package
+        links of the platform from a generation snapshot.
+        """
+        metapath = os.path.join(self.generations_path, platform, "%s.meta" % (generation,))
+
+        manifestsdir = os.path.join(self.manifests_path, platform)
+        if os.path.exists(manifestsdir):
+            misc.rmtree(manifestsdir)
+        misc.makedirs(manifestsdir)
+        for name in os.listdir(os.path.join(metapath, "manifests")):
+            os.link(os.path.join(metapath, "manifests", name), os.path.join(manifestsdir, name))
+
+        ownerspath = self.__get_owner_index_path(platform)
+        if os.path.exists(os.path.join(metapath, "owners.json")):
+            if os.path.exists(ownerspath+".tmp"):
+                misc.remove(ownerspath+".tmp")
+            os.link(os.path.join(metapath, "owners.json"), ownerspath+".tmp")
+            misc.rename(ownerspath+".tmp", ownerspath)
+        elif os.path.exists(ownerspath):
+            misc.remove(ownerspath)
+
+        published = json.load(open(os.path.join(metapath, "published.json")))
+        linkdir = os.path.join(self.published_path, platform)
+        if not os.path.exists(linkdir):
+            misc.makedirs(linkdir)
+        for name in os.listdir(linkdir):
+            linkname = os.path.join(linkdir, name)
+            if published.get(name) != os.readlink(linkname):
+                misc.remove(linkname)
+        for name, target in published.items():
+            linkname = os.path.join(linkdir, name)
+            if not os.path.lexists(linkname):
+                misc.symlink(target, linkname)
+
+    def __run_generation(self, platform, fn, *args):
+        """Run fn on a new staging generation of the platform tree and
+        make it current if fn succeeds. Platforms without generations
+        and nested calls run fn directly.
+
+        The paths changed by fn are journaled (see misc.journal) so
+        that the indexes need only be stamped for those.
+        """
+        if platform in self.staging:
+            return fn(*args)
+        nested = misc.journal != None
+        if not nested:
+            misc.journal = []
+        try:
+            if not self.is_generational(platform):
+                return fn(*args)
+            self.__begin_generation(platform)
+            try:
+                err = fn(*args)
+            except:
+                self.__abort_generation(platform)
+                raise
+            if is_error(err):
+                self.__abort_generation(platform)
+                return err
+            self.__commit_generation(platform)
+        finally:
+            if not nested:
+                misc.journal = None
+
+    def __snapshot_generation_meta(self, platform, generation, parent=None, reldirnames=None):
+        """Save the manifests, owner index and published package links
+        of the platform for a generation. Files are hard linked: they
+        are only ever replaced, never rewritten (see JsonFile.dump()).
+
+        The generation it was made from (parent) and the directories
+        changed from it are also recorded, if given.
+        """
+        metapath = os.path.join(self.generations_path, platform, "%s.meta" % (generation,))
+        if os.path.exists(metapath):
+            misc.rmtree(metapath)
+        misc.makedirs(os.path.join(metapath, "manifests"))
+
+        manifestsdir = os.path.join(self.manifests_path, platform)
+        if os.path.exists(manifestsdir):
+            for name in os.listdir(manifestsdir):
+                if not name.endswith(".tmp"):
+                    os.link(os.path.join(manifestsdir, name), os.path.join(metapath, "manifests", name))
+        ownerspath = self.__get_owner_index_path(platform)
+        if os.path.exists(ownerspath):
+            os.link(ownerspath, os.path.join(metapath, "owners.json"))
+        published = JsonFile()
+        published.d = self.get_index().get("published").get(platform, {})
+        published.dump(os.path.join(metapath, "published.json"))
+        if parent != None:
+            changes = JsonFile()
+            changes.set("parent", parent)
+            changes.set("dirs", sorted(reldirnames))
+            changes.dump(os.path.join(metapath, "changes.json"))
+
+    def __get_changed_dirs(self, platform):
+        """Return the directories of the platform tree, relative to it,
+        changed so far by the current operation: the parents of the
+        journaled paths and the journaled paths which are directories.
+        """
+        pubplatpath = self.get_platform_path(platform)
+        reldirnames = set()
+        for path in misc.journal or []:
+            if path.startswith(pubplatpath+"/"):
+                relpath = path[len(pubplatpath)+1:]
+                reldirnames.add(os.path.dirname(relpath))
+                if misc.isrealdir(path):
+                    reldirnames.add(relpath)
+        return reldirnames
+
+    def __get_colliding_owner(self, platform, owners, relpath, unfolds):
+        """Return the name of the package owning the link found at
+        relpath, relative to the platform directory, or None. A path
+        under folded directories to be unfolded (unfolds) is owned by
+        the owner of the outermost directory link.
+        """
+        name = owners.get_owner(relpath)
+        if name:
+            return name
+        reldirname = os.path.dirname(relpath)
+        while reldirname in unfolds:
+            name = owners.get_owner(reldirname)
+            if name:
+                pubplatpath = self.get_platform_path(platform)
+                return os.path.lexists(os.path.join(pubplatpath, relpath)) and name or None
+            reldirname = os.path.dirname(reldirname)
+        return None
+
+    def __get_control_index(self):
+        if self.control_index == None:
+            cindex = self.control_index = ControlIndex()
+            try:
+                cindex.load(self.controls_path)
+                if not cindex.is_current():
+                    cindex.clear()
+            except:
+                cindex.clear()
+        return self.control_index
+
+    def __put_control_index(self):
+        """Save the control index if it has changed. Failure to save
+        is not fatal: entries are reloaded as needed.
+        """
+        cindex = self.control_index
+        if cindex == None or not cindex.dirty or not self.is_owner():
+            return
+        try:
+            cindex.dump(self.controls_path, indent=None)
+            cindex.dirty = False
+        except:
+            if globls.debug:
+                traceback.print_exc()
+
+    def __get_depgraph_path(self, platform):
+        return os.path.join(self.depgraphs_path, "%s.json" % (platform,))
+
+    def __get_closures_path(self, platform, name=None):
+        path = os.path.join(self.depgraphs_path, "%s.closures" % (platform,))
+        return name and os.path.join(path, "%s.json" % (name,)) or path
+
+    def __get_closure(self, platform, name, digest):
+        """Return the saved closure (see get_requiredby()) of the name
+        for the platform if current, or None.
+        """
+        if "/" in name or name.startswith("."):
+            return None
+        cindex = ClosureIndex()
+        try:
+            cindex.load(self.__get_closures_path(platform, name))
+        except:
+            return None
+        if not cindex.is_current(os.path.join(self.published_path, platform), digest):
+            return None
+        return set(cindex.get("names"))
+
+    def __put_closure(self, platform, name, digest, names):
+        """Save the closure of the name for the platform. Failure to
+        save is not fatal.
+        """
+        if not self.is_owner() or "/" in name or name.startswith("."):
+            return
+        try:
+            path = self.__get_closures_path(platform)
+            if not os.path.exists(path):
+                misc.makedirs(path)
+            cindex = ClosureIndex()
+            cindex.set("mtime", get_mtime(os.path.join(self.published_path, platform)))
+            cindex.set("published", digest)
+            cindex.set("names", sorted(names))
+            cindex.dump(self.__get_closures_path(platform, name), indent=None)
+        except:
+            if globls.debug:
+                traceback.print_exc()
+
+    def __get_depgraph(self, platform):
+        """Return a dependency manager of the packages published for
+        the platform. The saved graph is used if it is current,
+        otherwise one is built from the package controls and saved.
+        """
+        dindex = DependencyIndex()
+        try:
+            dindex.load(self.__get_depgraph_path(platform))
+        except:
+            dindex.clear()
+        dm = DependencyManager()
+        if dindex.is_current(os.path.join(self.published_path, platform), self.get_index().get_published_digest(platform)):
+            dm.set_graph(dindex.get("graph"))
+            return dm
+        dm = self.__scan_depmgr([platform])
+        self.__put_depgraph(platform, dm)
         return dm
 
+    def __put_depgraph(self, platform, dm):
+        """Save the dependency graph of the platform, stamped with the
+        current mtime of the published link directory and digest of
+        the published packages, or remove the saved graph if dm is
+        None. The saved closures, now stale, are removed. Failure to
+        save is not fatal: the graph is rebuilt when next found to be
+        stale.
+        """
+        if not self.is_owner():
+            return
+        try:
+            closurespath = self.__get_closures_path(platform)
+            if os.path.exists(closurespath):
+                misc.rmtree(closurespath)
+            path = self.__get_depgraph_path(platform)
+            if dm == None:
+                if os.path.exists(path):
+                    misc.remove(path)
+                return
+            if not os.path.exists(self.depgraphs_path):
+                misc.makedirs(self.depgraphs_path)
+            dindex = DependencyIndex()
+            dindex.set("mtime", get_mtime(os.path.join(self.published_path, platform)))
+            dindex.set("published", self.get_index().get_published_digest(platform))
+            dindex.set("graph", dm.get_graph())
+            dindex.dump(path, indent=None)
+        except:
+            if globls.debug:
+                traceback.print_exc()
+
+    def __get_manifest_path(self, name, platform):
+        return os.path.join(self.manifests_path, platform, name)
+
+    def __get_manifest(self, name, platform):
+        pending = self.pending.get(platform)
+        if pending and name in pending["manifests"]:
+            return pending["manifests"][name]
+        path = self.__get_manifest_path(name, platform)
+        if not os.path.exists(path):
+            return None
+        manifest = PublishManifest()
+        manifest.load(path)
+        return manifest
+
+    def __put_manifest(self, name, platform, manifest):
+        if platform in self.staging:
+            self.pending[platform]["manifests"][name] = manifest
+            return
+        path = self.__get_manifest_path(name, platform)
+        linkdir = os.path.dirname(path)
+        if not os.path.exists(linkdir):
+            misc.makedirs(linkdir)
+        manifest.dump(path)
+
+    def __unset_manifest(self, name, platform):
+        if platform in self.staging:
+            self.pending[platform]["manifests"][name] = None
+            return
+        path = self.__get_manifest_path(name, platform)
+        if os.path.exists(path):
+            misc.remove(path)
+
+    def __get_owner_index_path(self, platform):
+        return os.path.join(self.owners_path, "%s.json" % (platform,))
+
+    def __load_owner_index(self, platform):
+        """Return the saved owner index of the platform if it is
+        current, or None. A staging generation is a copy of the
+        current platform tree, against which the index is checked.
+        """
+        owners = OwnerIndex()
+        path = self.__get_owner_index_path(platform)
+        try:
+            owners.load(path)
+        except:
+            return None
+        if not os.path.exists(path) or not owners.is_current(self.joinpath(platform)):
+            return None
+        return owners
+
+    def __put_owner_index(self, platform, owners, reldirnames=None, renew=False):
+        """Stamp and save the owner index. The directories changed are,
+        unless given, those journaled for the current operation (see
+        __get_changed_dirs()). While staging, the index is only saved
+        on commit.
+        """
+        if platform in self.staging:
+            self.pending[platform]["owners"] = owners
+            return
+        try:
+            path = self.__get_owner_index_path(platform)
+            if not os.path.exists(self.owners_path):
+                misc.makedirs(self.owners_path)
+            if reldirnames == None:
+                reldirnames = self.__get_changed_dirs(platform)
+            owners.stamp(self.get_platform_path(platform), reldirnames, renew)
+            owners.dump(path, indent=None)
+        except:
+            if globls.debug:
+                traceback.print_exc()
+
+    def __scan_owner_index(self, platform):
+        """Build the owner index of a platform by reading the links of
+        the platform tree and matching their targets against the
+        published packages. The mtime of each directory is taken
+        before it is read.
+        """
+        owners = OwnerIndex()
+        mtimes = owners.get("mtimes")
+        path2name = dict([(v, k) for k, v in self.get_index().get("published").get(platform, {}).items()])
+        pubplatpath = self.get_platform_path(platform)
+        mtimes[""] = get_mtime(pubplatpath)
+        for pubdirname in constants.PUBLISHABLE_DIRS:
+            reldirname = pubdirname
+            while reldirname:
+                if misc.isrealdir(os.path.join(pubplatpath, reldirname)):
+                    mtimes[reldirname] = get_mtime(os.path.join(pubplatpath, reldirname))
+                reldirname = os.path.dirname(reldirname)
+            for root, dirnames, filenames in os.walk(os.path.join(pubplatpath, pubdirname)):
+                for dirname in dirnames:
+                    dirpath = os.path.join(root, dirname)
+                    if not os.path.islink(dirpath):
+                        mtimes[dirpath[len(pubplatpath)+1:]] = get_mtime(dirpath)
+                # os.walk does not descend into (folded) directory links
+                for filename in filenames+dirnames:
+                    linkname = os.path.join(root, filename)
+                    try:
+                        target = os.readlink(linkname)
+                    except OSError:
+                        continue
+                    path = os.path.dirname(target)
+                    while path not in path2name and path not in ["/", ""]:
+                        path = os.path.dirname(path)
+                    if path in path2name:
+                        owners.set_owner(linkname[len(pubplatpath)+1:], path2name[path])
+        return owners
+
+    def __put_index(self, index, relpaths=None):
+        """Stamp and save the inventory index. Failure to save is not
+        fatal: the index is rebuilt when next found to be stale.
+        """
+        try:
+            index.stamp(self.path, relpaths)
+            index.dump(self.index_path)
+        except:
+            if globls.debug:
+                traceback.print_exc()
+
+    def __scan_index(self):
+        """Build the inventory index from the installed and published
+        link directories. Each directory mtime is taken before it is
+        read so that a concurrent change leaves the index stale.
+        """
+        def scan(relpath):
+            path = self.joinpath(relpath)
+            mtimes[relpath] = get_mtime(path)
+            d = {}
+            for name in os.listdir(path):
+                d[name] = os.readlink(os.path.join(path, name))
+            return d
+
+        index = InventoryIndex()
+        mtimes = index.get("mtimes")
+
+        installed_relpath = "etc/ssm.d/installed"
+        published_relpath = "etc/ssm.d/published"
+        if self.is_legacy():
+            index.set("installed", scan(installed_relpath))
+        else:
+            mtimes[installed_relpath] = get_mtime(self.installed_path)
+            installed = index.get("installed")
+            for plat in os.listdir(self.installed_path):
+                installed.update(scan(os.path.join(installed_relpath, plat)))
+        mtimes[published_relpath] = get_mtime(self.published_path)
+        published = index.get("published")
+        for plat in os.listdir(self.published_path):
+            published[plat] = scan(os.path.join(published_relpath, plat))
+        return index
+
     def __set_installed(self, pkg):
         #if self.is_legacy():
             #self.__set_installed_legacy(pkg)
             #return
 
+        index = self.get_index()
         linkdir = os.path.join(self.installed_path, pkg.platform)
         linkname = os.path.join(linkdir, pkg.name)
+        relpaths = [os.path.join("etc/ssm.d/installed", pkg.platform)]
         if not os.path.exists(linkdir):
             misc.makedirs(linkdir)
+            relpaths.append("etc/ssm.d/installed")
         misc.symlink(pkg.path, linkname, True)
+        index.set_installed(pkg.name, pkg.path)
+        self.__put_index(index, relpaths)
 
     def __set_installed_legacy(self, pkg):
         linkname = os.path.join(self.installed_path, pkg.name)
@@ -80,30 +624,297 @@ class Domain:
 
     def __set_published(self, pkg, platform=None):
         platform = platform or pkg.platform
+        if platform in self.staging:
+            self.pending[platform]["published"].append((pkg, True))
+            return
+        index = self.get_index()
+        try:
+            dm = self.__get_depgraph(platform)
+        except:
+            dm = None
         linkdir = os.path.join(self.published_path, platform)
         linkname = os.path.join(linkdir, pkg.name)
+        relpaths = [os.path.join("etc/ssm.d/published", platform)]
         if not os.path.exists(linkdir):
             misc.makedirs(linkdir)
+            relpaths.append("etc/ssm.d/published")
         misc.symlink(pkg.path, linkname, True)
+        index.set_published(platform, pkg.name, pkg.path)
+        self.__put_index(index, relpaths)
+        if dm:
+            try:
+                control = self.get_package_control(pkg)
+                dm.remove(control.get("name"))
+                dm.add(control.get("name"),
+                    control.get("version"),
+                    control.get("requires"),
+                    control.get("provides"),
+                    control.get("conflicts"))
+            except:
+                dm = None
+        self.__put_depgraph(platform, dm)
 
     def __unset_installed(self, pkg):
         if self.is_legacy():
             self.__unset_installed_legacy(pkg)
             return
 
+        index = self.get_index()
         linkdir = os.path.join(self.installed_path, pkg.platform)
         linkname = os.path.join(linkdir, pkg.name)      
         misc.remove(linkname)
+        index.unset_installed(pkg.name)
+        self.__put_index(index, [os.path.join("etc/ssm.d/installed", pkg.platform)])
 
     def __unset_installed_legacy(self, pkg):
+        index = self.get_index()
         linkname = os.path.join(self.installed_path, pkg.name)
         misc.remove(linkname)
+        index.unset_installed(pkg.name)
+        self.__put_index(index, ["etc/ssm.d/installed"])
 
     def __unset_published(self, pkg, platform=None):
         platform = platform or pkg.platform
+        if platform in self.staging:
+            self.pending[platform]["published"].append((pkg, False))
+            return
+        index = self.get_index()
+        try:
+            # keyed by control name, as in __set_published(); read
+            # while the package may still be reached through the link
+            dm = self.__get_depgraph(platform)
+            name = self.get_package_control(pkg).get("name")
+            if name == None:
+                dm = None
+        except:
+            dm = None
         linkdir = os.path.join(self.published_path, platform)
         linkname = os.path.join(linkdir, pkg.name)      
         misc.remove(linkname)
+        index.unset_published(platform, pkg.name)
+        self.__put_index(index, [os.path.join("etc/ssm.d/published", platform)])
+        if dm:
+            dm.remove(name)
+        self.__put_depgraph(platform, dm)
+
+    def __refold(self, platform, reldirname, owners):
+        """Replace a directory of links into a single package directory
+        by a link to the package directory. Only directories unfolded
+        from a folded publish are refolded.
+        """
+        pubplatpath = self.get_platform_path(platform)
+        path = os.path.join(pubplatpath, reldirname)
+        if not misc.isrealdir(path):
+            return False
+        names = os.listdir(path)
+        if not names:
+            return False
+        name = owners.get_owner(os.path.join(reldirname, names[0]))
+        manifest = name and self.__get_manifest(name, platform)
+        if not manifest or reldirname not in manifest.get("unfolded"):
+            return False
+        target = manifest.get_target(reldirname)
+        try:
+            for name2 in names:
+                if os.readlink(os.path.join(path, name2)) != os.path.join(target, name2):
+                    return False
+            if sorted(os.listdir(target)) != sorted(names):
+                return False
+        except OSError:
+            return False
+
+        relpaths = [os.path.join(reldirname, name2) for name2 in names]
+        for relpath in relpaths:
+            misc.remove(os.path.join(pubplatpath, relpath))
+            owners.unset_owner(relpath, name)
+        misc.rmdir(path)
+        misc.symlink(target, path)
+        owners.set_owner(reldirname, name)
+
+        relpaths = set(relpaths)
+        manifest.set("links", [x for x in manifest.get("links") if x not in relpaths]+[reldirname])
+        manifest.get("dirs").remove(reldirname)
+        manifest.get("unfolded").remove(reldirname)
+        self.__put_manifest(name, platform, manifest)
+        return True
+
+    def __unfold(self, platform, reldirname, owners):
+        """Replace a (folded) directory link by a directory of links to
+        the entries of the linked directory. The published view is
+        unchanged.
+        """
+        pubplatpath = self.get_platform_path(platform)
+        path = os.path.join(pubplatpath, reldirname)
+        target = os.path.join(os.path.dirname(path), os.readlink(path))
+        names = os.listdir(target)
+        misc.remove(path)
+        misc.mkdir(path)
+        relpaths = [os.path.join(reldirname, name) for name in names]
+        for name in names:
+            misc.symlink(os.path.join(target, name), os.path.join(path, name))
+
+        name = owners.get_owner(reldirname)
+        manifest = name and self.__get_manifest(name, platform)
+        if manifest:
+            owners.unset_owner(reldirname, name)
+            for relpath in relpaths:
+                owners.set_owner(relpath, name)
+            manifest.get("links").remove(reldirname)
+            manifest.get("links").extend(relpaths)
+            manifest.add_dir(reldirname)
+            manifest.get("unfolded").append(reldirname)
+            self.__put_manifest(name, platform, manifest)
+
+    def __prune_dirs(self, platform, reldirnames):
+        """Remove the empty directories among those given and their
+        ancestors below the publishable directories, deepest first.
+        """
+        pubplatpath = self.get_platform_path(platform)
+        dirs = set()
+        for relpath in reldirnames:
+            while relpath and relpath not in constants.PUBLISHABLE_DIRS:
+                dirs.add(relpath)
+                relpath = os.path.dirname(relpath)
+        for relpath in sorted(dirs, key=lambda x: x.count("/"), reverse=True):
+            try:
+                misc.rmdir(os.path.join(pubplatpath, relpath))
+            except:
+                pass
+
+    def __remove_manifest_links(self, manifest, platform, reldirnames):
+        """Remove the links recorded in the manifest which still point
+        into the package. The directories to prune are added to
+        reldirnames. Return the relative paths of the removed links.
+        """
+        pubplatpath = self.get_platform_path(platform)
+        reldirnames.update(manifest.get("dirs"))
+        relpaths = []
+        for relpath in manifest.get("links"):
+            linkname = os.path.join(pubplatpath, relpath)
+            try:
+                if os.readlink(linkname) != manifest.get_target(relpath):
+                    continue
+            except OSError:
+                continue
+            misc.remove(linkname)
+            relpaths.append(relpath)
+            reldirnames.add(os.path.dirname(relpath))
+        return relpaths
+
+    def __unpublish_manifest(self, manifest, platform):
+        """Remove the links recorded in the manifest which still point
+        into the package, then prune emptied directories. Return the
+        relative paths of the removed links.
+        """
+        reldirnames = set()
+        relpaths = self.__remove_manifest_links(manifest, platform, reldirnames)
+        self.__prune_dirs(platform, reldirnames)
+        return relpaths
+
+    def __unpublish_walk(self, pkgs, platform):
+        """Search the platform tree, once, for links into any of the
+        packages. Return a map of package name to the relative paths
+        of the removed links.
+        """
+        def get_candidate(path):
+            while path not in path2pkg and path not in ["/", ""]:
+                path = os.path.dirname(path)
+            return path2pkg.get(path)
+
+        pubplatpath = self.get_platform_path(platform)
+        path2pkg = dict([(pkg.path, pkg) for pkg in pkgs]+[(os.path.realpath(pkg.path), pkg) for pkg in pkgs])
+        name2relpaths = dict([(pkg.name, []) for pkg in pkgs])
+        for pubdirname in constants.PUBLISHABLE_DIRS:
+            # TODO: implement os.walk() for older pythons
+            pubdirpath = os.path.join(pubplatpath, pubdirname)
+            for root, dirnames, filenames in os.walk(pubdirpath, topdown=False):
+                rmcount = 0
+                for filename in filenames:
+                    linkname = os.path.join(root, filename)
+                    relpath = linkname[len(pubplatpath)+1:]
+                    # the candidate package is that of the link target
+                    # or of its real path; the link is into it if it
+                    # resolves as the package path joined with the link
+                    # relative path (which may itself be a link)
+                    try:
+                        target = os.path.normpath(os.path.join(root, os.readlink(linkname)))
+                    except OSError:
+                        continue
+                    realpath = os.path.realpath(linkname)
+                    pkg = get_candidate(target) or get_candidate(realpath)
+                    if pkg and os.path.realpath(pkg.joinpath(relpath)) == realpath:
+                        misc.remove(linkname)
+                        name2relpaths[pkg.name].append(relpath)
+                        rmcount += 1
+                if rmcount == len(filenames):
+                    # try to remove possibly empty directory
+                    if root != pubdirpath:
+                        try:
+                            misc.rmdir(root)
+                        except:
+                            pass
+        return name2relpaths
+
+    def drop_platform(self, platform, background=False):
+        """Unpublish all packages of a platform at once.
+
+        The published links, platform tree, generations, manifests,
+        owner index and dependency graph of the platform are moved
+        aside, under etc/ssm.d/trash, which leaves the domain
+        consistent. They are then deleted or, if background is set,
+        left to a background process to delete.
+
+        Only a published platform (or one with generations) may be
+        dropped.
+        """
+        if not self.is_owner():
+            return Error("must own domain")
+        if platform in ["", "."] or "/" in platform or ".." in platform:
+            return Error("bad platform name (%s)" % (platform,))
+        if platform not in self.get_published_platforms() and not self.is_generational(platform):
+            return Error("platform is not published (%s)" % (platform,))
+        if platform in self.staging:
+            return Error("platform is being published")
+        try:
+            trashpath = self.joinpath("etc/ssm.d/trash")
+            if not os.path.exists(trashpath):
+                misc.makedirs(trashpath)
+            # published links first so that packages are no longer
+            # published even if a later step fails
+            trashpaths = []
+            for path in [os.path.join(self.published_path, platform),
+                self.joinpath(platform),
+                os.path.join(self.generations_path, platform),
+                os.path.join(self.manifests_path, platform),
+                self.__get_owner_index_path(platform),
+                self.__get_depgraph_path(platform),
+                self.__get_closures_path(platform)]:
+                if os.path.lexists(path):
+                    trashpath2 = os.path.join(trashpath, "%s.%s.%s" % (platform, os.getpid(), len(trashpaths)))
+                    misc.rename(path, trashpath2)
+                    trashpaths.append(trashpath2)
+            index = self.get_index()
+            index.get("published").pop(platform, None)
+            self.__put_index(index, ["etc/ssm.d/published",
+                os.path.join("etc/ssm.d/published", platform)])
+        except:
+            if globls.debug:
+                traceback.print_exc()
+            return Error("could not drop platform (%s)" % (platform,))
+
+        try:
+            if background:
+                subprocess.Popen(["rm", "-rf"]+trashpaths, close_fds=True)
+            else:
+                for path in trashpaths:
+                    if misc.isrealdir(path):
+                        misc.rmtree(path)
+                    else:
+                        misc.remove(path)
+        except:
+            if globls.debug:
+                traceback.print_exc()
+            return Error("could not delete dropped platform files under (%s)" % (trashpath,))
 
     def exists(self):
         return os.path.isdir(self.path) \
@@ -113,6 +924,8 @@ class Domain:
         """Return list of packages dependent on the given one
         published for the platform.
         """
+        if pkg == None:
+            return []
         ppkgs = self.get_published_packages([platform])
         short2ppkg = dict([(ppkg.short, ppkg) for ppkg in ppkgs])
 
@@ -124,9 +937,108 @@ class Domain:
             for pkgshort in pkgshorts:
                 pkgs.append(short2ppkg[pkgshort])
         except:
-            pkgs = []
+            if globls.debug:
+                traceback.print_exc()
+            return Error("could not get dependents (%s)" % (sys.exc_value,))
         return pkgs
 
+    def get_requiredby(self, shorts, platform, indirect=False):
+        """Return the short names of the packages published for the
+        platform which require (directly or, if indirect, also
+        indirectly) any of the given short names. The saved
+        dependency graph, and the closure of each name queried
+        indirectly, are used until the published packages of the
+        platform change.
+        """
+        try:
+            if not indirect:
+                pkgshorts = self.__get_depgraph(platform).get_requiredby(shorts)
+            else:
+                digest = self.get_index().get_published_digest(platform)
+                dm = None
+                pkgshorts = set()
+                for short in shorts:
+                    names = self.__get_closure(platform, short, digest)
+                    if names == None:
+                        if dm == None:
+                            dm = self.__get_depgraph(platform)
+                        names = dm.get_requiredby([short], True)
+                        self.__put_closure(platform, short, digest, names)
+                    pkgshorts.update(names)
+        except:
+            if globls.debug:
+                traceback.print_exc()
+            return Error("could not get dependents (%s)" % (sys.exc_value,))
+        return sorted(pkgshorts.difference(shorts))
+
+    def get_current_generation(self, platform):
+        """Return the current generation number of the platform tree,
+        or None if the platform does not use generations.
+        """
+        try:
+            relpath = os.readlink(self.joinpath(platform))
+            if os.path.dirname(relpath) == os.path.join("etc/ssm.d/generations", platform):
+                return int(os.path.basename(relpath))
+        except:
+            pass
+        return None
+
+    def get_generations(self, platform):
+        """Return the sorted generation numbers of the platform tree.
+        """
+        _, dirnames, _ = oswalk1(os.path.join(self.generations_path, platform))
+        return sorted([int(dirname) for dirname in dirnames if dirname.isdigit()])
+
+    def get_index(self):
+        """Return the inventory index, rebuilding it if it is missing
+        or stale. A rebuilt index is saved only by the domain owner.
+        The index is kept for the life of the domain object and
+        reused while it is current.
+        """
+        if self.index and self.index.is_current(self.path):
+            return self.index
+        index = InventoryIndex()
+        try:
+            index.load(self.index_path)
+        except:
+            index.clear()
+        if not index.is_current(self.path):
+            index = self.__scan_index()
+            if self.is_owner():
+                self.__put_index(index)
+        self.index = index
+        return index
+
+    def get_owner_index(self, platform):
+        """Return the owner index for the platform, building it if it
+        is missing. A built index is saved only by the domain owner.
+        """
+        pending = self.pending.get(platform)
+        if pending and pending["owners"]:
+            return pending["owners"]
+        owners = self.__load_owner_index(platform)
+        if owners == None:
+            owners = self.__scan_owner_index(platform)
+            if self.is_owner():
+                self.__put_owner_index(platform, owners)
+        if pending:
+            pending["owners"] = owners
+        return owners
+
+    def get_path_owner(self, relpath, platform):
+        """Return the name of the package owning the published path
+        (relative to the platform directory), or None. A path under a
+        folded directory is owned by the owner of the directory link.
+        """
+        owners = self.get_owner_index(platform)
+        relpath = os.path.normpath(relpath)
+        while relpath:
+            name = owners.get_owner(relpath)
+            if name:
+                return name
+            relpath = os.path.dirname(relpath)
+        return None
+
     def get_installed_package(self, name):
         try:
             pkg = Package(self.joinpath(name))
@@ -165,27 +1077,9 @@ class Domain:
         d["path"] = self.path
         d["meta"] = self.get_meta().getall()
         d["legacy"] = self.is_legacy()
-        installed = {}
-        if d["legacy"]:
-            for name in os.listdir(self.installed_path):
-                path = os.path.join(self.installed_path, name)
-                installed[name] = os.readlink(path)
-        else:
-            for plat in os.listdir(self.installed_path):
-                root = os.path.join(self.installed_path, plat)
-                for name in os.listdir(root):
-                    path = os.path.join(root, name)
-                    installed[name] = os.readlink(path)
-        d["installed"] = installed
-        published = {}
-        for plat in os.listdir(self.published_path):
-            platpublished = {}
-            root = os.path.join(self.published_path, plat)
-            for name in os.listdir(root):
-                path = os.path.join(root, name)
-                platpublished[name] = os.readlink(path)
-            published[plat] = platpublished
-        d["published"] = published
+        index = self.get_index()
+        d["installed"] = index.get("installed")
+        d["published"] = index.get("published")
         return d
 
     def get_meta(self):
@@ -193,6 +1087,23 @@ class Domain:
         meta.load(self.meta_path)
         return meta
 
+    def get_package_control(self, pkg):
+        """Return the control of the package from the control index
+        (etc/ssm.d/controls.json), if the entry is current, or from
+        the package control file, which is then added to the index.
+        """
+        cindex = self.__get_control_index()
+        stamp = get_stamp(pkg.control_path)
+        d = cindex.get_control(pkg.name, stamp)
+        if d != None:
+            control = Control()
+            control.d = dict(d)
+        else:
+            control = pkg.get_control()
+            if stamp != None:
+                cindex.set_control(pkg.name, stamp, dict(control.getall()))
+        return control
+
     def get_published_package(self, name, platform=None):
         try:
             pkg = Package(name)
@@ -205,15 +1116,20 @@ class Domain:
         try:
             pkg = Package(name)
             platform = platform or pkg.platform
-            root, dirnames, _ = oswalk1(os.path.join(self.published_path, platform))
-            for dirname in dirnames:
-                ppkg = Package(os.path.join(root, dirname))
-                if pkg.short == ppkg.short:
-                    if ppkg.exists():
-                        return ppkg
-                    return None
+            pname = self.get_index().get_published_short(platform, pkg.short)
+            if pname:
+                ppkg = Package(os.path.join(self.published_path, platform, pname))
+                if ppkg.exists():
+                    return ppkg
         except:
-            return None
+            pass
+        return None
+
+    def get_platform_path(self, platform):
+        """Return the path of the platform tree to operate on: the
+        staging generation, if any, or the published platform tree.
+        """
+        return self.staging.get(platform) or self.joinpath(platform)
 
     def get_published_platforms(self):
         _, platforms, _ = oswalk1(self.published_path)
@@ -267,6 +1183,9 @@ class Domain:
                 self.legacy = False
         return self.legacy
 
+    def is_generational(self, platform):
+        return self.get_current_generation(platform) != None
+
     def is_owner(self):
         try:
             return os.stat(self.path).st_uid == os.getuid()
@@ -277,11 +1196,14 @@ class Domain:
     def is_published(self, pkg, platforms=None):
         if not pkg.exists():
             return False
-        platforms = platforms or self.get_published_platforms()
+        published = self.get_index().get("published")
+        platforms = platforms or published.keys()
         for platform in platforms:
-            ppkg = self.get_published_package(pkg.name, platform)
-            if ppkg and ppkg.realpath == pkg.realpath:
-                return True
+            target = published.get(platform, {}).get(pkg.name)
+            if target != None:
+                linkdir = os.path.join(self.published_path, platform)
+                if os.path.realpath(os.path.join(linkdir, target)) == pkg.realpath:
+                    return True
         return False
 
     def joinpath(self, *comps):
@@ -298,21 +1220,27 @@ class Domain:
         os.symlink(self.path, self.selfpath)
         self.put_meta(meta)
 
-    def install(self, pkgfile, force=False, reinstall=False):
+    def install(self, pkgfile, force=False, reinstall=False, jobs=1):
         if not self.is_owner():
             return Error("must own domain")
-        if pkgfile.is_valid() < 0:
-            return Error("package file is not valid")
         pkg = Package(self.joinpath(pkgfile.name))
         if self.is_installed(pkg) and not reinstall and not force:
             return Error("package already installed")
         try:
-            err = pkgfile.unpack(self.path)
+            # checked while unpacking; nothing is left on error
+            err = pkgfile.unpack(self.path, jobs)
             if is_error(err):
-                # TODO: clean up? set broken?
                 return err
             pkg.execute_script("post-install", self.path)
             self.__set_installed(pkg)
+            # refresh, whatever the stamp of the new control file, and
+            # drop the saved dependency graphs built from the old one
+            self.__get_control_index().unset_control(pkg.name)
+            self.get_package_control(pkg)
+            for platform in self.get_index().get("published").keys():
+                if self.is_published(pkg, [platform]):
+                    self.__put_depgraph(platform, None)
+            self.__put_control_index()
         except:
             if globls.debug:
                 traceback.print_exc()
@@ -321,13 +1249,51 @@ class Domain:
     def prepublish(self, pkg, platform):
         """Check that a package could be published.
         """
+        return self.__prepublish(pkg, platform)
+
+    def prepublish_platforms(self, pkg, platforms):
+        """Check that a package could be published to each of the
+        platforms. Controls come from the control index, so each is
+        read at most once however many platforms it is published to.
+        """
+        for platform in platforms:
+            err = self.__prepublish(pkg, platform)
+            if is_error(err):
+                return Error("%s for platform (%s)" % (err, platform))
+
+    def preupgrade(self, oldpkg, pkg, platform):
+        """Check that a published package could be upgraded to another
+        version of it (see upgrade()).
+        """
+        return self.__preupgrade(oldpkg, pkg, platform)
+
+    def __preupgrade(self, oldpkg, pkg, platform):
+        try:
+            # check requires of the new version and its dependents
+            dm = self.__create_depmgr([platform], [oldpkg.short])
+            control = self.get_package_control(pkg)
+            dm.add(control.get("name"),
+                control.get("version"),
+                control.get("requires"),
+                control.get("provides"),
+                control.get("conflicts"))
+            deppkgs = self.get_dependents(oldpkg, platform)
+            if is_error(deppkgs):
+                return deppkgs
+            dm.generate([pkg.short]+[deppkg.short for deppkg in deppkgs if deppkg.short != oldpkg.short])
+        except:
+            if globls.debug:
+                traceback.print_exc()
+            return Error("upgrade was unsuccessful (%s)" % (sys.exc_value,))
+
+    def __prepublish(self, pkg, platform):
         ppkgs = self.get_published_packages([platform])
         short2ppkg = dict([(ppkg.short, ppkg) for ppkg in ppkgs])
 
         try:
             # find missing requires
             dm = self.__create_depmgr([platform])
-            control = pkg.get_control()
+            control = self.get_package_control(pkg)
             dm.add(control.get("name"),
                 control.get("version"),
                 control.get("requires"),
@@ -343,7 +1309,147 @@ class Domain:
                 traceback.print_exc()
             return Error("prepublish was unsuccessful (%s)" % (sys.exc_value,))
 
-    def publish(self, pkg, platform, force=False):
+    def enable_generations(self, platform):
+        """Convert the platform tree to generation 1 of a platform
+        with generations. The platform tree path becomes a link to the
+        current generation.
+        """
+        if not self.is_owner():
+            return Error("must own domain")
+        if self.is_generational(platform):
+            return Error("platform already uses generations")
+        try:
+            pubplatpath = self.joinpath(platform)
+            path = os.path.join(self.generations_path, platform, "1")
+            misc.makedirs(os.path.dirname(path))
+            if os.path.exists(pubplatpath):
+                misc.rename(pubplatpath, path)
+            else:
+                misc.mkdir(path)
+            misc.relink(self.__get_generation_relpath(platform, 1), pubplatpath)
+            self.__snapshot_generation_meta(platform, 1)
+        except:
+            if globls.debug:
+                traceback.print_exc()
+            return Error("could not enable generations")
+
+    def get_publish_order(self, pkgs, platform):
+        """Return the packages ordered for publishing, dependencies
+        first.
+
+        A single dependency manager (of the published packages, less
+        other versions of those given, plus those given) is used to
+        order the packages and to check, up front, the requires of
+        the packages and of their published dependents.
+        """
+        short2pkg = dict([(pkg.short, pkg) for pkg in pkgs])
+        if len(short2pkg) != len(pkgs):
+            return Error("more than one version of a package given")
+        try:
+            dm = self.__create_depmgr([platform], short2pkg.keys())
+            for pkg in pkgs:
+                control = self.get_package_control(pkg)
+                dm.add(control.get("name"),
+                    control.get("version"),
+                    control.get("requires"),
+                    control.get("provides"),
+                    control.get("conflicts"))
+            # given packages and their dependents, dependencies first
+            pkgshorts = dm.generate(list(dm.get_requiredby(short2pkg.keys(), True)))
+        except:
+            if globls.debug:
+                traceback.print_exc()
+            return Error("prepublish was unsuccessful (%s)" % (sys.exc_value,))
+        return [short2pkg[pkgshort] for pkgshort in pkgshorts if pkgshort in short2pkg]
+
+    def get_publish_plan(self, pkg, platform, fold=False, dircache=None, tree=None):
+        """Return a manifest of the directories to create and the
+        links to make to publish a package. Folded directory links
+        which must first be unfolded are listed in manifest.unfolds.
+        Links to files found where a directory is to be created are
+        listed in manifest.blocked.
+
+        Each directory is checked at most once; the subdirectories
+        of a missing directory are known to be missing. If fold is
+        set, a missing directory below a publishable directory is
+        linked rather than created and its contents are not walked.
+
+        dircache, if given, maps directory relative paths to their
+        state ("missing", "link" or "dir") and is shared across
+        plans (see publish_many()). tree, if given, is the result of
+        pkg.get_publishable_tree() and is shared across platforms
+        (see publish_platforms()).
+        """
+        def get_state(reldirname):
+            state = dircache.get(reldirname) if dircache != None else None
+            if state == None:
+                path = os.path.join(pubplatpath, reldirname)
+                if not os.path.lexists(path):
+                    state = "missing"
+                elif os.path.islink(path):
+                    state = "link"
+                else:
+                    state = "dir"
+                if dircache != None:
+                    dircache[reldirname] = state
+            return state
+
+        manifest = PublishManifest(pkg.path)
+        pubplatpath = self.get_platform_path(platform)
+        planned = set()
+        missing = set()
+        unfolds = set()
+        folded = set()
+        if tree == None:
+            tree = pkg.get_publishable_tree()
+        for relpath, dirnames, filenames in tree:
+            if relpath in folded:
+                # contents of a folded directory are not linked
+                folded.update([os.path.join(relpath, dirname) for dirname in dirnames])
+                continue
+            # TODO: support ./.../.
+            for reldirname in [relpath]+[os.path.join(relpath, dirname) for dirname in dirnames]:
+                if reldirname in planned:
+                    continue
+                planned.add(reldirname)
+                parent = os.path.dirname(reldirname)
+                state = (parent in missing) and "missing" or get_state(reldirname)
+                if state == "link" or (state == "dir" and parent in unfolds):
+                    # entries of an unfolded directory are links
+                    if os.path.isdir(os.path.join(pubplatpath, reldirname)):
+                        unfolds.add(reldirname)
+                        manifest.unfolds.append(reldirname)
+                        continue
+                    # a link to a file is in the way
+                    manifest.blocked.append(reldirname)
+                    state = "missing"
+                if state == "missing":
+                    missing.add(reldirname)
+                    if fold and reldirname != relpath:
+                        manifest.add_folded(reldirname)
+                        folded.add(reldirname)
+                    else:
+                        manifest.add_dir(reldirname)
+            for filename in filenames:
+                manifest.add_link(os.path.join(relpath, filename))
+        return manifest
+
+    def publish(self, pkg, platform, force=False, jobs=1, fold=False):
+        """Publish package.
+
+        The directories and links to publish are planned first.
+        Folded directories of other packages which are published into
+        are unfolded. Directories are then created and links are made
+        using up to jobs threads. If fold is set, directories not
+        shared with other packages are linked rather than created
+        (see get_publish_plan()).
+
+        For a platform with generations, the changes are made to a new
+        generation which then replaces the current one atomically.
+        """
+        return self.__run_generation(platform, self.__publish, pkg, platform, force, jobs, fold)
+
+    def __publish(self, pkg, platform, force, jobs, fold, dircache=None, tree=None):
         if not self.is_owner():
             return Error("must own domain")
         if self.is_published(pkg, [platform]):
@@ -353,29 +1459,220 @@ class Domain:
                 err = self.unpublish(pkg, platform)
                 if is_error(err):
                     return err
+                if dircache:
+                    dircache.clear()
         try:
-            pubplatpath = self.joinpath(platform)
-            for pubdirname in constants.PUBLISHABLE_DIRS:
-                for root, dirnames, filenames in os.walk(pkg.joinpath(pubdirname)):
-                    relpath = os.path.join(root)[len(pkg.path)+1:]
-                    pubbasedir = os.path.join(pubplatpath, relpath)
-                    if not os.path.exists(pubbasedir):
-                        misc.makedirs(pubbasedir)
-                    for dirname in dirnames:
-                        # TODO: support ./.../.
-                        #misc.makedirs(self.joinpath(relpath, dirname))
-                        pubsubdir = os.path.join(pubbasedir, dirname)
-                        if not os.path.exists(pubsubdir):
-                            misc.makedirs(os.path.join(pubbasedir, dirname))
-                    for filename in filenames:
-                        linkname = os.path.join(pubplatpath, relpath, filename)
-                        misc.symlink(os.path.join(root, filename), linkname, force)
+            manifest = self.get_publish_plan(pkg, platform, fold, dircache, tree)
+            pubplatpath = self.get_platform_path(platform)
+
+            # check for links owned by other packages, or paths owned
+            # by none, before changing anything
+            owners = self.get_owner_index(platform)
+            unfolds = set(manifest.unfolds)
+            for relpath in manifest.blocked+manifest.get("links"):
+                owner = self.__get_colliding_owner(platform, owners, relpath, unfolds)
+                if owner not in [None, pkg.name] and not force:
+                    return Error("path (%s) is published by package (%s)" % (relpath, owner))
+            for relpath in manifest.get("links"):
+                if not force and os.path.lexists(os.path.join(pubplatpath, relpath)) \
+                    and self.__get_colliding_owner(platform, owners, relpath, unfolds) == None:
+                    return Error("path (%s) exists and is not published by a package" % (relpath,))
+
+            for reldirname in manifest.unfolds:
+                self.__unfold(platform, reldirname, owners)
+            for reldirname in manifest.blocked:
+                owner = self.__get_colliding_owner(platform, owners, reldirname, unfolds)
+                misc.remove(os.path.join(pubplatpath, reldirname))
+                owners.unset_owner(reldirname, owner)
+            if manifest.unfolds or manifest.blocked:
+                self.__put_owner_index(platform, owners)
+
+            def link(relpath):
+                misc.symlink(manifest.get_target(relpath), os.path.join(pubplatpath, relpath), force)
+
+            for relpath in manifest.get("dirs"):
+                misc.makedirs(os.path.join(pubplatpath, relpath))
+            misc.pmap(link, manifest.get("links"), jobs)
+            for relpath in manifest.get("links"):
+                owners.set_owner(relpath, pkg.name)
+            if dircache != None:
+                for reldirname in manifest.unfolds+manifest.get("dirs"):
+                    dircache[reldirname] = "dir"
+                for reldirname in manifest.get("folded"):
+                    dircache[reldirname] = "link"
+            self.__put_owner_index(platform, owners)
+            self.__put_manifest(pkg.name, platform, manifest)
             self.__set_published(pkg, platform)
         except:
             if globls.debug:
                 traceback.print_exc()
             return Error("publish was unsuccessful")
 
+    def upgrade(self, oldpkg, pkg, platform, force=False, jobs=1, fold=False):
+        """Replace a published package by another version of it.
+
+        Links common to both versions are retargeted atomically, links
+        of the old version only are removed and links of the new
+        version only are made. The published packages depending on
+        the old version stay published and must be satisfied by the
+        new version.
+
+        If the old version has no manifest or was published folded,
+        or if fold is set, the old version is unpublished and the new
+        one published.
+        """
+        return self.__run_generation(platform, self.__upgrade, oldpkg, pkg, platform, force, jobs, fold)
+
+    def __upgrade(self, oldpkg, pkg, platform, force, jobs, fold, check=True):
+        if not self.is_owner():
+            return Error("must own domain")
+        if not self.is_published(oldpkg, [platform]):
+            return Error("package is not published")
+
+        if check:
+            err = self.__preupgrade(oldpkg, pkg, platform)
+            if is_error(err):
+                return err
+
+        oldmanifest = self.__get_manifest(oldpkg.name, platform)
+        if fold or not oldmanifest or oldmanifest.get("folded"):
+            err = self.unpublish(oldpkg, platform)
+            if is_error(err):
+                return err
+            return self.publish(pkg, platform, force, jobs, fold)
+
+        try:
+            manifest = self.get_publish_plan(pkg, platform)
+            pubplatpath = self.get_platform_path(platform)
+
+            # check for links owned by packages other than the old
+            # version, or paths owned by none, before changing anything
+            owners = self.get_owner_index(platform)
+            unfolds = set(manifest.unfolds)
+            for relpath in manifest.blocked+manifest.get("links"):
+                owner = self.__get_colliding_owner(platform, owners, relpath, unfolds)
+                if owner not in [None, pkg.name, oldpkg.name] and not force:
+                    return Error("path (%s) is published by package (%s)" % (relpath, owner))
+            oldlinks = set(oldmanifest.get("links"))
+            for relpath in manifest.get("links"):
+                if not force and relpath not in oldlinks and os.path.lexists(os.path.join(pubplatpath, relpath)) \
+                    and self.__get_colliding_owner(platform, owners, relpath, unfolds) == None:
+                    return Error("path (%s) exists and is not published by a package" % (relpath,))
+
+            for reldirname in manifest.unfolds:
+                self.__unfold(platform, reldirname, owners)
+            for reldirname in manifest.blocked:
+                owner = self.__get_colliding_owner(platform, owners, reldirname, unfolds)
+                misc.remove(os.path.join(pubplatpath, reldirname))
+                owners.unset_owner(reldirname, owner)
+                if owner == oldpkg.name:
+                    # now a directory; not to be removed with the old links
+                    oldmanifest.get("links").remove(reldirname)
+            if manifest.unfolds or manifest.blocked:
+                self.__put_owner_index(platform, owners)
+
+            oldlinks = set(oldmanifest.get("links"))
+            def link(relpath):
+                target = manifest.get_target(relpath)
+                linkname = os.path.join(pubplatpath, relpath)
+                if relpath in oldlinks:
+                    misc.relink(target, linkname)
+                else:
+                    misc.symlink(target, linkname, force)
+
+            for relpath in manifest.get("dirs"):
+                misc.makedirs(os.path.join(pubplatpath, relpath))
+            misc.pmap(link, manifest.get("links"), jobs)
+            for relpath in manifest.get("links"):
+                owners.set_owner(relpath, pkg.name)
+
+            # remove links of the old version only
+            links = set(manifest.get("links"))
+            oldmanifest.set("links", [x for x in oldmanifest.get("links") if x not in links])
+            for relpath in self.__unpublish_manifest(oldmanifest, platform):
+                owners.unset_owner(relpath, oldpkg.name)
+
+            self.__put_owner_index(platform, owners)
+            self.__put_manifest(pkg.name, platform, manifest)
+            self.__unset_manifest(oldpkg.name, platform)
+            self.__unset_published(oldpkg, platform)
+            self.__set_published(pkg, platform)
+        except:
+            if globls.debug:
+                traceback.print_exc()
+            return Error("upgrade was unsuccessful")
+
+    def rollback(self, platform, generation=None):
+        """Make an earlier generation (default is the one preceding the
+        current) the current one, restoring its metadata.
+        """
+        if not self.is_owner():
+            return Error("must own domain")
+        current = self.get_current_generation(platform)
+        if current == None:
+            return Error("platform does not use generations")
+        generations = self.get_generations(platform)
+        if generation == None:
+            generations = [x for x in generations if x < current]
+            if not generations:
+                return Error("no earlier generation")
+            generation = generations[-1]
+        elif generation not in generations:
+            return Error("generation (%s) not found" % (generation,))
+        try:
+            self.__restore_generation_meta(platform, generation)
+            misc.relink(self.__get_generation_relpath(platform, generation), self.joinpath(platform))
+        except:
+            if globls.debug:
+                traceback.print_exc()
+            return Error("rollback was unsuccessful")
+
+    def publish_many(self, pkgs, platform, force=False, jobs=1, fold=False):
+        """Publish several packages in dependency order (see
+        get_publish_order()).
+
+        Packages with another version published are upgraded (see
+        upgrade()). The directory state found while planning is
+        shared between the packages. For a platform with generations,
+        all packages are published in a single new generation.
+        """
+        if not self.is_owner():
+            return Error("must own domain")
+        pkgs = err = self.get_publish_order(pkgs, platform)
+        if is_error(err):
+            return err
+        return self.__run_generation(platform, self.__publish_many, pkgs, platform, force, jobs, fold)
+
+    def __publish_many(self, pkgs, platform, force, jobs, fold):
+        dircache = {}
+        for pkg in pkgs:
+            if globls.verbose:
+                sys.stderr.write("info: publishing package (%s)\n" % (pkg.name,))
+            ppkg = self.get_published_package_short(pkg.name, platform)
+            if ppkg and ppkg.name != pkg.name:
+                err = self.__upgrade(ppkg, pkg, platform, force, jobs, fold, check=False)
+                dircache.clear()
+            else:
+                err = self.__publish(pkg, platform, force, jobs, fold, dircache)
+            if is_error(err):
+                return Error("%s (%s)" % (err, pkg.name))
+
+    def publish_platforms(self, pkg, platforms, force=False, jobs=1, fold=False):
+        """Publish package to several platforms. The package is walked
+        once and the resulting tree is planned against, and published
+        to, each platform in turn (see publish()).
+        """
+        try:
+            tree = pkg.get_publishable_tree()
+        except:
+            if globls.debug:
+                traceback.print_exc()
+            return Error("publish was unsuccessful")
+        for platform in platforms:
+            err = self.__run_generation(platform, self.__publish, pkg, platform, force, jobs, fold, None, tree)
+            if is_error(err):
+                return Error("%s for platform (%s)" % (err, platform))
+
     def put_meta(self, meta):
         meta.dump(self.meta_path)
 
@@ -388,6 +1685,8 @@ class Domain:
             pkg.execute_script("pre-uninstall", self.path)
             misc.rmtree(pkg.path)
             self.__unset_installed(pkg)
+            self.__get_control_index().unset_control(pkg.name)
+            self.__put_control_index()
         except:
             if globls.debug:
                 traceback.print_exc()
@@ -395,30 +1694,66 @@ class Domain:
 
     def unpublish(self, pkg, platform):
         """Unpublish package.
+
+        The links recorded in the publish manifest are removed. If
+        there is no manifest (e.g., the package was published by an
+        older ssm), the platform tree is searched for links into the
+        package.
         """
+        return self.__run_generation(platform, self.__unpublish, pkg, platform)
+
+    def __unpublish(self, pkg, platform):
         if not self.is_published(pkg, [platform]) and not globls.force:
             return Error("package is not published")
+        return self.__unpublish_many([pkg], platform)
+
+    def unpublish_many(self, pkgs, platform):
+        """Unpublish several packages in one pass.
+
+        As for unpublish(), but the platform tree is searched at most
+        once, for links into any of the packages without a manifest,
+        and emptied directories are pruned and refolded once at the
+        end.
+        """
+        return self.__run_generation(platform, self.__unpublish_many, pkgs, platform)
+
+    def __unpublish_many(self, pkgs, platform):
+        if not globls.force:
+            for pkg in pkgs:
+                if not self.is_published(pkg, [platform]):
+                    return Error("package is not published (%s)" % (pkg.name,))
         try:
-            pubplatpath = self.joinpath(platform)
-            for pubdirname in constants.PUBLISHABLE_DIRS:
-                # TODO: implement os.walk() for older pythons
-                pubdirpath = os.path.join(pubplatpath, pubdirname)
-                for root, dirnames, filenames in os.walk(pubdirpath, topdown=False):
-                    rmcount = 0
-                    for filename in filenames:
-                        linkname = os.path.join(root, filename)
-                        pkgfilepath = pkg.joinpath(root[len(pubplatpath)+1:], filename)
-                        if os.path.realpath(linkname) == os.path.realpath(pkgfilepath):
-                            misc.remove(linkname)
-                            rmcount += 1
-                    if rmcount == len(filenames):
-                        # try to remove possibly empty directory
-                        if root != pubdirpath:
-                            try:
-                                misc.rmdir(root)
-                            except:
-                                pass
-            self.__unset_published(pkg, platform)
+            owners = self.get_owner_index(platform)
+            name2relpaths = {}
+            reldirnames = set()
+            walkpkgs = []
+            for pkg in pkgs:
+                manifest = self.__get_manifest(pkg.name, platform)
+                if manifest:
+                    name2relpaths[pkg.name] = self.__remove_manifest_links(manifest, platform, reldirnames)
+                else:
+                    walkpkgs.append(pkg)
+            if walkpkgs:
+                name2relpaths.update(self.__unpublish_walk(walkpkgs, platform))
+            self.__prune_dirs(platform, reldirnames)
+            for name, relpaths in name2relpaths.items():
+                for relpath in relpaths:
+                    owners.unset_owner(relpath, name)
+
+            # refold directories unfolded for these packages, deepest first
+            reldirnames = set()
+            for relpaths in name2relpaths.values():
+                for relpath in relpaths:
+                    reldirname = os.path.dirname(relpath)
+                    while reldirname and reldirname not in constants.PUBLISHABLE_DIRS:
+                        reldirnames.add(reldirname)
+                        reldirname = os.path.dirname(reldirname)
+            for reldirname in sorted(reldirnames, key=lambda x: x.count("/"), reverse=True):
+                self.__refold(platform, reldirname, owners)
+            self.__put_owner_index(platform, owners)
+            for pkg in pkgs:
+                self.__unset_published(pkg, platform)
+                self.__unset_manifest(pkg.name, platform)
         except:
             if globls.debug:
                 traceback.print_exc()
@@ -0,0 +1,306 @@
+#! /usr/bin/env python2
+#
+# ssm/index.py
+
+# GPL--start
+# This file is part of ssm (Simple Software Manager)
+# Copyright (C) 2005-2012 Environment/Environnement Canada
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+import hashlib
+import os
+import os.path
+
+from ssm.jsonfile import JsonFile
+
+INDEX_VERSION = 1
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except:
+        return None
+
+def get_stamp(path):
+    """Return the mtime, size, inode and ctime of a file, or None. A
+    file rewritten or replaced is unlikely to keep all four, even
+    with its mtime preserved (e.g., extracted with a fixed mtime).
+    """
+    try:
+        st = os.stat(path)
+        return [st.st_mtime, st.st_size, st.st_ino, st.st_ctime]
+    except:
+        return None
+
+class InventoryIndex(JsonFile):
+    """Cached copy of the installed and published package links of a
+    domain.
+
+    The index is only valid while the mtimes of the link directories
+    under etc/ssm.d match those recorded in it. Directory paths are
+    stored relative to the domain so that the index survives a domain
+    being accessed through another path.
+
+    A map of short name to published package name, per platform, is
+    derived on demand and is not saved.
+    """
+
+    def __init__(self):
+        JsonFile.__init__(self)
+        self.clear()
+
+    def clear(self):
+        self.d = {
+            "version": INDEX_VERSION,
+            "installed": {},
+            "published": {},
+            "mtimes": {},
+        }
+        self.short2name = {}
+
+    def get_published_digest(self, platform):
+        """Return a digest of the packages published for the platform,
+        which identifies the published set.
+        """
+        published = self.d["published"].get(platform, {})
+        return hashlib.md5("\n".join(["%s %s" % item for item in sorted(published.items())])).hexdigest()
+
+    def get_published_short(self, platform, short):
+        """Return the name of the package published for the platform
+        with the given short name, or None.
+        """
+        short2name = self.short2name.get(platform)
+        if short2name == None:
+            short2name = self.short2name[platform] = {}
+            for name in self.d["published"].get(platform, {}):
+                short2name[name.split("_", 1)[0]] = name
+        return short2name.get(short)
+
+    def is_current(self, dompath):
+        if self.d.get("version") != INDEX_VERSION:
+            return False
+        mtimes = self.d.get("mtimes")
+        if not mtimes:
+            return False
+        for relpath, mtime in mtimes.items():
+            if get_mtime(os.path.join(dompath, relpath)) != mtime:
+                return False
+        return True
+
+    def load(self, path):
+        JsonFile.load(self, path)
+        self.short2name = {}
+
+    def set_installed(self, name, target):
+        self.d["installed"][name] = target
+
+    def set_published(self, platform, name, target):
+        self.d["published"].setdefault(platform, {})[name] = target
+        short2name = self.short2name.get(platform)
+        if short2name != None:
+            short2name[name.split("_", 1)[0]] = name
+
+    def stamp(self, dompath, relpaths=None):
+        """Record the current mtimes of the named directories, those
+        changed by the operation being saved. If any other recorded
+        directory has changed since the index was loaded, the index
+        can no longer be trusted and is cleared so that it is rebuilt.
+        """
+        relpaths = relpaths or []
+        mtimes = self.d["mtimes"]
+        for relpath, mtime in mtimes.items():
+            if relpath not in relpaths \
+                and get_mtime(os.path.join(dompath, relpath)) != mtime:
+                self.clear()
+                return
+        for relpath in relpaths:
+            mtime = get_mtime(os.path.join(dompath, relpath))
+            if mtime == None:
+                mtimes.pop(relpath, None)
+            else:
+                mtimes[relpath] = mtime
+
+    def unset_installed(self, name):
+        self.d["installed"].pop(name, None)
+
+    def unset_published(self, platform, name):
+        platpublished = self.d["published"].get(platform)
+        if platpublished != None:
+            platpublished.pop(name, None)
+        short2name = self.short2name.get(platform)
+        if short2name != None and short2name.get(name.split("_", 1)[0]) == name:
+            del short2name[name.split("_", 1)[0]]
+
+class OwnerIndex(JsonFile):
+    """Map of published paths, relative to the platform directory, to
+    the name of the package owning the link.
+
+    As for InventoryIndex, the index is only valid while the mtimes of
+    the directories of the platform tree match those recorded in it.
+    """
+
+    def __init__(self):
+        JsonFile.__init__(self)
+        self.clear()
+
+    def clear(self):
+        self.d = {
+            "version": INDEX_VERSION,
+            "owners": {},
+            "mtimes": {},
+        }
+
+    def get_owner(self, relpath):
+        return self.d["owners"].get(relpath)
+
+    def is_current(self, platpath):
+        if self.d.get("version") != INDEX_VERSION:
+            return False
+        mtimes = self.d.get("mtimes")
+        if not mtimes:
+            return False
+        for reldirname, mtime in mtimes.items():
+            if get_mtime(os.path.join(platpath, reldirname)) != mtime:
+                return False
+        return True
+
+    def set_owner(self, relpath, name):
+        self.d["owners"][relpath] = name
+
+    def stamp(self, platpath, reldirnames=None, renew=False):
+        """Record the current mtimes of the named directories, those
+        changed by the operation being saved. If any other recorded
+        directory has changed, the index is cleared so that it is
+        rebuilt, unless renew is set, in which case they are recorded
+        anew (e.g., for a new copy of the platform tree).
+        """
+        reldirnames = reldirnames or []
+        mtimes = self.d["mtimes"]
+        if renew:
+            reldirnames = set(mtimes.keys()+list(reldirnames))
+        else:
+            for reldirname, mtime in mtimes.items():
+                if reldirname not in reldirnames \
+                    and get_mtime(os.path.join(platpath, reldirname)) != mtime:
+                    self.clear()
+                    return
+        for reldirname in reldirnames:
+            path = os.path.join(platpath, reldirname)
+            if os.path.isdir(path) and not os.path.islink(path):
+                mtimes[reldirname] = get_mtime(path)
+            else:
+                # removed or replaced by a (folded) directory link
+                mtimes.pop(reldirname, None)
+
+    def unset_owner(self, relpath, name):
+        """Remove the entry for relpath if it is owned by name.
+        """
+        owners = self.d["owners"]
+        if owners.get(relpath) == name:
+            del owners[relpath]
+
+class ControlIndex(JsonFile):
+    """Cached copy of the control data of packages, keyed by package
+    name. An entry is only valid while the stamp (see get_stamp()) of
+    the package control file matches that recorded in it.
+    """
+
+    def __init__(self):
+        JsonFile.__init__(self)
+        self.clear()
+
+    def clear(self):
+        self.d = {
+            "version": INDEX_VERSION,
+            "controls": {},
+        }
+        self.dirty = False
+
+    def get_control(self, name, stamp):
+        """Return the control data for the package if current, or
+        None.
+        """
+        entry = self.d["controls"].get(name)
+        if entry and stamp != None and entry.get("stamp") == stamp:
+            return entry.get("control")
+        return None
+
+    def is_current(self):
+        return self.d.get("version") == INDEX_VERSION
+
+    def set_control(self, name, stamp, d):
+        self.d["controls"][name] = {"stamp": stamp, "control": d}
+        self.dirty = True
+
+    def unset_control(self, name):
+        if self.d["controls"].pop(name, None) != None:
+            self.dirty = True
+
+class DependencyIndex(JsonFile):
+    """Saved dependency graph (see DependencyManager.get_graph()) of
+    the packages published for a platform. The graph is only valid
+    while the mtime of the published link directory of the platform
+    and the digest of the published packages (see
+    InventoryIndex.get_published_digest()) match those recorded in it;
+    mtimes alone may not change within a second. Only the direct
+    edges are kept; reverse dependency closures are kept apart (see
+    ClosureIndex).
+    """
+
+    def __init__(self):
+        JsonFile.__init__(self)
+        self.clear()
+
+    def clear(self):
+        self.d = {
+            "version": INDEX_VERSION,
+            "mtime": None,
+            "published": None,
+            "graph": None,
+        }
+
+    def is_current(self, path, digest):
+        return self.d.get("version") == INDEX_VERSION \
+            and self.d.get("graph") != None \
+            and self.d.get("mtime") == get_mtime(path) \
+            and self.d.get("published") == digest
+
+class ClosureIndex(JsonFile):
+    """Saved reverse dependency closure (see
+    DependencyManager.get_requiredby()) of one name, for the packages
+    published for a platform. One is saved for each name queried,
+    so that the size of each stays linear in the number of packages.
+    It is valid under the same conditions as DependencyIndex.
+    """
+
+    def __init__(self):
+        JsonFile.__init__(self)
+        self.clear()
+
+    def clear(self):
+        self.d = {
+            "version": INDEX_VERSION,
+            "mtime": None,
+            "published": None,
+            "names": None,
+        }
+
+    def is_current(self, path, digest):
+        return self.d.get("version") == INDEX_VERSION \
+            and self.d.get("names") != None \
+            and self.d.get("mtime") == get_mtime(path) \
+            and self.d.get("published") == digest
@@ -22,6 +22,7 @@
 # GPL--end
 
 import json
+import os
 import os.path
 
 class JsonFile:
@@ -33,7 +34,14 @@ class JsonFile:
         self.d = {}
 
     def dump(self, path, indent=2, sort_keys=False):
-        return json.dump(self.d, open(path, "w"), indent=indent, sort_keys=sort_keys)
+        """Write to a temporary file which is then renamed to path so
+        that readers (and hard links to the old file) never see a
+        partial file.
+        """
+        tmppath = "%s.tmp" % (path,)
+        with open(tmppath, "w") as f:
+            json.dump(self.d, f, indent=indent, sort_keys=sort_keys)
+        os.rename(tmppath, path)
 
     def dumps(self, indent=2, sort_keys=False):
         return json.dumps(self.d, indent=indent, sort_keys=sort_keys)
@@ -48,5 +56,8 @@ class JsonFile:
         if os.path.exists(path):
             self.d.update(json.load(open(path)))
 
+    def loads(self, s):
+        self.d.update(json.loads(s))
+
     def set(self, k, v):
         self.d[k] = v
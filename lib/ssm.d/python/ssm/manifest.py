@@ -0,0 +1,62 @@
+#! /usr/bin/env python2
+#
+# ssm/manifest.py
+
+# GPL--start
+# This file is part of ssm (Simple Software Manager)
+# Copyright (C) 2005-2012 Environment/Environnement Canada
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+import os.path
+
+from ssm.jsonfile import JsonFile
+
+class PublishManifest(JsonFile):
+    """Record of the links and directories created when publishing a
+    package to a platform.
+
+    Links and directories are stored relative to the platform
+    directory. Link targets are the package path joined with the
+    link relative path. Folded directory links are also listed
+    under "folded" and, if later unfolded, under "unfolded".
+    """
+
+    def __init__(self, pkgpath=None):
+        JsonFile.__init__(self)
+        self.d = {
+            "path": pkgpath,
+            "links": [],
+            "dirs": [],
+            "folded": [],
+            "unfolded": [],
+        }
+        # planned only, not saved
+        self.unfolds = []
+        self.blocked = []
+
+    def add_dir(self, relpath):
+        self.d["dirs"].append(relpath)
+
+    def add_folded(self, relpath):
+        self.d["links"].append(relpath)
+        self.d["folded"].append(relpath)
+
+    def add_link(self, relpath):
+        self.d["links"].append(relpath)
+
+    def get_target(self, relpath):
+        return os.path.join(self.d["path"], relpath)
@@ -22,6 +22,7 @@
 # GPL--end
 
 import grp
+from multiprocessing.pool import ThreadPool
 import os
 import os.path
 import pwd
@@ -31,6 +32,10 @@ import traceback
 
 from ssm import globls
 
+# when set to a list, the paths changed by the functions below are
+# appended to it (see Domain.__run_generation())
+journal = None
+
 def columnize(lines, displaywidth=80, gapwidth=2):
     _lines = []
     gap = " "*gapwidth
@@ -51,6 +56,36 @@ def columnize(lines, displaywidth=80, gapwidth=2):
             _lines.append("".join(_line))
     return _lines
 
+def copylinks(srcpath, dstpath):
+    """Copy a tree of directories and symlinks. Symlinks are hard
+    linked (not followed), or copied where hard links fail.
+    """
+    try:
+        if globls.verbose:
+            sys.stderr.write("info: copylinks(%s, %s)\n" % (srcpath, dstpath))
+        os.mkdir(dstpath)
+        for root, dirnames, filenames in os.walk(srcpath):
+            dstroot = os.path.join(dstpath, root[len(srcpath)+1:])
+            for dirname in dirnames:
+                srcname = os.path.join(root, dirname)
+                dstname = os.path.join(dstroot, dirname)
+                if os.path.islink(srcname):
+                    # folded directory; do not descend
+                    filenames.append(dirname)
+                else:
+                    os.mkdir(dstname)
+            for filename in filenames:
+                srcname = os.path.join(root, filename)
+                dstname = os.path.join(dstroot, filename)
+                try:
+                    os.link(srcname, dstname)
+                except OSError:
+                    os.symlink(os.readlink(srcname), dstname)
+    except:
+        if globls.debug:
+            sys.stderr.write("%s\n" % traceback.format_exc())
+        raise
+
 def exits(msg, status=1):
     sys.stderr.write("%s\n" % str(msg))
     sys.exit(status)
@@ -91,6 +126,10 @@ def makedirs(path, mode=0755):
     try:
         if globls.verbose:
             sys.stderr.write("info: makedirs(%s,%o)\n" % (path, mode))
+        head = path
+        while head not in ["/", ""] and not os.path.lexists(head):
+            note(head)
+            head = os.path.dirname(head)
         os.makedirs(path, mode)
     except:
         if globls.debug:
@@ -101,17 +140,37 @@ def mkdir(path, mode=0755):
     try:
         if globls.verbose:
             sys.stderr.write("info: mkdir(%s,%o)\n" % (path, mode))
+        note(path)
         os.mkdir(path, mode)
     except:
         if globls.debug:
              sys.stderr.write("%s\n" % traceback.format_exc())
         raise
 
+def note(path):
+    """Record a changed path in the journal, if set.
+    """
+    if journal != None:
+        journal.append(path)
+
 def oswalk1(path):
     for root, dirnames, filenames in os.walk(path):
         return root, dirnames, filenames
     return path, [], []
 
+def pmap(fn, l, jobs=1):
+    """Like map() but using up to jobs threads. Intended for I/O bound
+    operations (e.g., on NFS) where the GIL is released.
+    """
+    if jobs <= 1 or len(l) <= 1:
+        return map(fn, l)
+    pool = ThreadPool(min(jobs, len(l)))
+    try:
+        return pool.map(fn, l)
+    finally:
+        pool.close()
+        pool.join()
+
 def puts(path, s):
     try:
         open(path, "w").write(s)
@@ -119,10 +178,28 @@ def puts(path, s):
     except:
         return None
 
+def relink(src, linkname):
+    """Replace (or make) a symlink atomically.
+    """
+    try:
+        if globls.verbose:
+            sys.stderr.write("info: relink(%s, %s)\n" % (src, linkname))
+        note(linkname)
+        tmpname = "%s.ssm-tmp" % (linkname,)
+        if os.path.islink(tmpname):
+            os.remove(tmpname)
+        os.symlink(src, tmpname)
+        os.rename(tmpname, linkname)
+    except:
+        if globls.debug:
+             sys.stderr.write("%s\n" % traceback.format_exc())
+        raise
+
 def remove(path):
     try:
         if globls.verbose:
             sys.stderr.write("info: remove(%s)\n" % (path,))
+        note(path)
         os.remove(path)
     except:
         if globls.debug:
@@ -133,6 +210,7 @@ def removedirs(path):
     try:
         if globls.verbose:
             sys.stderr.write("info: removedirs(%s)\n" % (path,))
+        note(path)
         os.removedirs(path)
     except:
         if globls.debug:
@@ -143,6 +221,8 @@ def rename(oldpath, newpath):
     try:
         if globls.verbose:
             sys.stderr.write("info: rename(%s, %s)\n" % (oldpath, newpath))
+        note(oldpath)
+        note(newpath)
         os.rename(oldpath, newpath)
     except:
         if globls.debug:
@@ -153,6 +233,7 @@ def rmdir(path):
     try:
         if globls.verbose:
             sys.stderr.write("info: rmdir(%s)\n" % (path,))
+        note(path)
         os.rmdir(path)
     except:
         if globls.debug:
@@ -163,6 +244,7 @@ def rmtree(path):
     try:
         if globls.verbose:
             sys.stderr.write("info: rmtree(%s)\n" % (path,))
+        note(path)
         shutil.rmtree(path)
     except:
         if globls.debug:
@@ -175,12 +257,64 @@ def symlink(src, linkname, force=False):
             remove(linkname)
         if globls.verbose:
             sys.stderr.write("info: symlink(%s, %s)\n" % (src, linkname))
+        note(linkname)
         os.symlink(src, linkname)
     except:
         if globls.debug:
              sys.stderr.write("%s\n" % traceback.format_exc())
         raise
 
+def synclinks(srcpath, dstpath, reldirnames):
+    """Make the named directories of a tree of directories and
+    symlinks (see copylinks()) the same as those of another tree.
+    Links already hard linked to those of the source tree are left
+    alone and directories not found in the destination tree are
+    copied whole. Parent directories are synced before their
+    subdirectories.
+    """
+    try:
+        if globls.verbose:
+            sys.stderr.write("info: synclinks(%s, %s)\n" % (srcpath, dstpath))
+        def discard(path):
+            if isrealdir(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+
+        for reldirname in sorted(reldirnames, key=lambda x: x and x.count("/")+1 or 0):
+            srcdir = os.path.join(srcpath, reldirname)
+            dstdir = os.path.join(dstpath, reldirname)
+            if not isrealdir(srcdir):
+                # removed or replaced by a link; see parent
+                continue
+            if not isrealdir(dstdir):
+                discard(dstdir)
+                copylinks(srcdir, dstdir)
+                continue
+            srcnames = os.listdir(srcdir)
+            for name in set(os.listdir(dstdir)).difference(srcnames):
+                discard(os.path.join(dstdir, name))
+            for name in srcnames:
+                srcname = os.path.join(srcdir, name)
+                dstname = os.path.join(dstdir, name)
+                if isrealdir(srcname):
+                    if not isrealdir(dstname):
+                        discard(dstname)
+                        copylinks(srcname, dstname)
+                    continue
+                if not isrealdir(dstname) and os.path.lexists(dstname) \
+                    and os.lstat(dstname).st_ino == os.lstat(srcname).st_ino:
+                    continue
+                discard(dstname)
+                try:
+                    os.link(srcname, dstname)
+                except OSError:
+                    os.symlink(os.readlink(srcname), dstname)
+    except:
+        if globls.debug:
+            sys.stderr.write("%s\n" % traceback.format_exc())
+        raise
+
 def uid2username(uid):
     try:
         pw = pwd.getpwuid(uid)
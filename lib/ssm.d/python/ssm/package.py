@@ -28,6 +28,7 @@ import re
 import subprocess
 import traceback
 
+from ssm import constants
 from ssm import globls
 from ssm.control import Control
 from ssm.misc import oswalk1, puts
@@ -77,19 +78,50 @@ def split_pkgref(pkgref):
         return None
     return dompath, pkgname, platform
 
-class Package:
+def _intern(s):
+    return type(s) == str and intern(s) or s
+
+class Package(object):
+    """Installed or published package.
+
+    Packages are created in large numbers when listing a domain, so
+    attributes are slotted, and the real path and control paths are
+    only computed when first used.
+    """
+
+    __slots__ = ["path", "name", "short", "version", "platform",
+        "_realpath", "_control_path", "_control_path_legacy"]
 
     def __init__(self, path, splitname=True):
         path = os.path.abspath(path)
         self.path = path
-        self.realpath = os.path.realpath(path)
         self.name = os.path.basename(path)
         if splitname:
-            self.short, self.version, self.platform = self.name.split("_", 2)
+            short, version, platform = self.name.split("_", 2)
+            self.short, self.version, self.platform = _intern(short), version, _intern(platform)
         else:
             self.short, self.version, self.platform = self.name, None, None
-        self.control_path = self.joinpath(".ssm.d/control.json")
-        self.control_path_legacy = self.joinpath(".ssm.d/control")
+        self._realpath = None
+        self._control_path = None
+        self._control_path_legacy = None
+
+    @property
+    def control_path(self):
+        if self._control_path == None:
+            self._control_path = self.joinpath(".ssm.d/control.json")
+        return self._control_path
+
+    @property
+    def control_path_legacy(self):
+        if self._control_path_legacy == None:
+            self._control_path_legacy = self.joinpath(".ssm.d/control")
+        return self._control_path_legacy
+
+    @property
+    def realpath(self):
+        if self._realpath == None:
+            self._realpath = os.path.realpath(self.path)
+        return self._realpath
 
     def __str__(self):
         return "<Package name (%s, %s, %s)>" % (self.short, self.version, self.platform)
@@ -141,6 +173,17 @@ class Package:
     def get_members(self, pattern=None):
         return find_paths(self.path, "", re.compile(pattern or ".*"))
 
+    def get_publishable_tree(self):
+        """Return the (relpath, dirnames, filenames) tuples, as given
+        by os.walk(), of the publishable directories of the package.
+        Paths are relative to the package.
+        """
+        tree = []
+        for pubdirname in constants.PUBLISHABLE_DIRS:
+            for root, dirnames, filenames in os.walk(self.joinpath(pubdirname)):
+                tree.append((root[len(self.path)+1:], dirnames, filenames))
+        return tree
+
     def has_control(self, legacy=False):
         if legacy:
             return os.path.exists(self.control_path_legacy)
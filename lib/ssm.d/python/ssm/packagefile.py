@@ -21,11 +21,24 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 # GPL--end
 
+import bz2
+import copy
+from distutils.spawn import find_executable
+import errno
+import grp
 import json
+from multiprocessing.pool import ThreadPool
 import os.path
+import pwd
 import string
+import StringIO
+import struct
+import subprocess
+import sys
 import tarfile
+import tempfile
 import traceback
+import zlib
 
 from pyerrors.errors import Error, is_error
 
@@ -35,6 +48,506 @@ from ssm import misc
 from ssm.control import Control
 from ssm.package import Package
 
+# A blocked package file is a gzip file of several members, which
+# any gzip and tar reader takes as a single tar stream:
+#   * body blocks: regular files only, each block of whole files,
+#     about BLOCK_SIZE bytes uncompressed
+#   * a head block: directories
+#   * a tail block: links and other members
+#   * an index member: the tar end-of-archive followed by the JSON
+#     block index
+#   * a trailer member, with no content, whose extra field
+#     (subfield BLOCK_INDEX_ID) gives the offset of the index member
+# Body blocks can be extracted independently, hence in parallel.
+BLOCK_SIZE = 4*1024*1024
+BLOCK_INDEX_ID = "SI"
+BLOCK_READ_SIZE = 256*1024
+
+# chunk compressed by each thread of ParallelGzipWriter
+PARALLEL_CHUNK_SIZE = 1024*1024
+
+# codec -> (magic, default level, levels, compress command,
+# decompress command); gzip, bz2 and none are done in process, the
+# others by their programs, if found
+CODECS = {
+    "none": (None, None, [], None, None),
+    "gzip": ("\x1f\x8b", 9, range(1, 10), None, None),
+    "bz2": ("BZh", 9, range(1, 10), None, None),
+    "xz": ("\xfd7zXZ\0", 6, range(0, 10), "xz -q -c -%s", "xz -q -d -c"),
+    "zstd": ("\x28\xb5\x2f\xfd", 3, range(1, 20), "zstd -q -c -%s", "zstd -q -d -c"),
+    "lz4": ("\x04\x22\x4d\x18", 1, range(1, 13), "lz4 -q -c -%s", "lz4 -q -d -c"),
+}
+
+def get_codecs():
+    """Return the names of the codecs available.
+    """
+    return sorted([codec for codec, t in CODECS.items() \
+        if not t[3] or find_executable(t[3].split()[0])])
+
+def parse_codec(s):
+    """Return (codec, level) from "<codec>[:<level>]".
+    """
+    codec, _, level = s.partition(":")
+    if codec not in CODECS:
+        raise Exception("unknown codec (%s)" % (codec,))
+    if codec not in get_codecs():
+        raise Exception("codec (%s) not available" % (codec,))
+    _, defaultlevel, levels, _, _ = CODECS[codec]
+    if not level:
+        return codec, defaultlevel
+    if not level.isdigit() or int(level) not in levels:
+        raise Exception("bad level (%s) for codec (%s)" % (level, codec))
+    return codec, int(level)
+
+def get_codec(path):
+    """Return the codec of a (compressed) file, by its magic
+    number. Anything else is taken to be uncompressed.
+    """
+    f = open(path, "rb")
+    try:
+        s = f.read(8)
+    finally:
+        f.close()
+    for codec, t in CODECS.items():
+        if t[0] and s.startswith(t[0]):
+            return codec
+    return "none"
+
+def open_tar_stream(path):
+    """Return a TarFile reading the file as a stream, whatever its
+    codec.
+    """
+    codec = get_codec(path)
+    command = CODECS[codec][4]
+    if codec == "gzip":
+        # tarfile streams stop at the end of the first member of a
+        # multi-member file (see ParallelGzipWriter)
+        reader = GzipReader(path, 0, os.path.getsize(path))
+    elif codec == "bz2":
+        reader = BZ2Reader(path)
+    elif command:
+        if codec not in get_codecs():
+            raise Exception("codec (%s) not available" % (codec,))
+        reader = CommandReader(command.split()+[path])
+    else:
+        return tarfile.open(path, "r|*", tarinfo=StreamTarInfo)
+    tarf = tarfile.open(fileobj=reader, mode="r|", tarinfo=StreamTarInfo)
+    # have the stream close (and wait for) the reader
+    tarf.fileobj._extfileobj = False
+    return tarf
+
+class StreamTarInfo(tarfile.TarInfo):
+    """TarInfo recording, as the end attribute of the tar file, the
+    header error which ended its members (see finish_tar_stream()).
+    tarfile takes a missing, truncated or bad header after the first
+    member as the end of the archive.
+    """
+
+    @classmethod
+    def fromtarfile(cls, tarf):
+        try:
+            return super(StreamTarInfo, cls).fromtarfile(tarf)
+        except tarfile.HeaderError as e:
+            tarf.end = e
+            raise
+
+def finish_tar_stream(tarf, marker=True):
+    """Check that the members of a tar file opened in stream mode,
+    all read, ended with the end-of-archive marker or, if not marker
+    (see BlockTarFile), at the end of the stream. The rest of the
+    stream is then read so that its reader can check that the
+    stream was not cut short (see GzipReader and CommandReader).
+    """
+    end = getattr(tarf, "end", None)
+    if marker and not isinstance(end, tarfile.EOFHeaderError):
+        raise Exception("missing end-of-archive marker")
+    if not marker and not isinstance(end, tarfile.EmptyHeaderError):
+        raise Exception("bad or truncated member header")
+    while tarf.fileobj.read(BLOCK_READ_SIZE):
+        pass
+
+class CommandReader:
+    """File-like object reading the output of a command. The exit
+    status of the command is checked on close if the output was read
+    to the end; otherwise the command may fail writing to the closed
+    pipe, so its error output is kept aside and only reported with a
+    failure.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.errf = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=self.errf)
+        self.eof = False
+
+    def read(self, n=-1):
+        s = self.proc.stdout.read(n)
+        if n < 0 or (n > 0 and not s):
+            self.eof = True
+        return s
+
+    def close(self):
+        if self.proc.stdout.closed:
+            return
+        self.proc.stdout.close()
+        try:
+            if self.proc.wait() != 0 and self.eof:
+                self.errf.seek(0)
+                raise Exception("command failed (%s): %s" % (" ".join(self.args), self.errf.read().strip()))
+        finally:
+            self.errf.close()
+
+class CommandWriter:
+    """File-like object writing to a file through a command (e.g., a
+    compressor).
+    """
+
+    def __init__(self, f, args):
+        self.args = args
+        self.proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=f)
+        self.size = 0
+
+    def tell(self):
+        return self.size
+
+    def write(self, s):
+        self.size += len(s)
+        self.proc.stdin.write(s)
+
+    def close(self):
+        self.proc.stdin.close()
+        if self.proc.wait() != 0:
+            raise Exception("command failed (%s)" % (" ".join(self.args),))
+
+class CompressorWriter:
+    """File-like object writing to a file through a compressor
+    object (e.g., bz2.BZ2Compressor), or directly if None.
+    """
+
+    def __init__(self, f, cobj=None):
+        self.f = f
+        self.cobj = cobj
+        self.size = 0
+
+    def tell(self):
+        return self.size
+
+    def write(self, s):
+        self.size += len(s)
+        if self.cobj:
+            s = self.cobj.compress(s)
+        self.f.write(s)
+
+    def close(self):
+        if self.cobj:
+            self.f.write(self.cobj.flush())
+
+def read_member(path, name, first=False):
+    """Return the content of a member of a tar file, or None if not
+    found. The file is read as a stream only as far as the member
+    (or the first member, if first), so a member at the start costs
+    little whatever the size of the file.
+    """
+    tarf = open_tar_stream(path)
+    try:
+        for member in tarf:
+            if os.path.normpath(member.name) == name:
+                if not member.isreg():
+                    return None
+                return tarf.extractfile(member).read()
+            if first:
+                break
+    finally:
+        tarf.close()
+    return None
+
+class GzipMemberWriter:
+    """Write one gzip member to a file, incrementally.
+    """
+
+    def __init__(self, f, level=6, extra=None):
+        self.f = f
+        self.offset = f.tell()
+        self.crc = zlib.crc32("")
+        self.size = 0
+        self.cobj = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        if extra:
+            f.write("\x1f\x8b\x08\x04\0\0\0\0\0\xff"+struct.pack("<H", len(extra))+extra)
+        else:
+            f.write("\x1f\x8b\x08\0\0\0\0\0\0\xff")
+
+    def tell(self):
+        return self.size
+
+    def write(self, s):
+        self.crc = zlib.crc32(s, self.crc)
+        self.size += len(s)
+        self.f.write(self.cobj.compress(s))
+
+    def close(self):
+        """Finish the member and return its (offset, size).
+        """
+        self.f.write(self.cobj.flush())
+        self.f.write(struct.pack("<II", self.crc & 0xffffffffL, self.size & 0xffffffffL))
+        return self.offset, self.f.tell()-self.offset
+
+def get_block_trailer(offset):
+    """Return the trailer member giving the offset of the index
+    member.
+    """
+    f = StringIO.StringIO()
+    GzipMemberWriter(f, extra=BLOCK_INDEX_ID+struct.pack("<HQ", 8, offset)).close()
+    return f.getvalue()
+
+BLOCK_TRAILER_SIZE = len(get_block_trailer(0))
+
+class GzipReader:
+    """File-like object reading the decompressed content of one or
+    more consecutive gzip members of a file.
+    """
+
+    def __init__(self, path, offset, size):
+        self.f = open(path, "rb")
+        self.f.seek(offset)
+        self.left = size
+        self.dobj = zlib.decompressobj(16+zlib.MAX_WBITS)
+        self.pending = ""
+        self.buf = ""
+
+    def close(self):
+        self.f.close()
+
+    def __check_end(self):
+        """Raise an exception if the data ends within a member: data
+        past the end of a complete member is left unused, whereas an
+        incomplete one takes it in.
+        """
+        if not self.dobj.unused_data:
+            try:
+                self.dobj.decompress("\0")
+            except zlib.error:
+                pass
+        if not self.dobj.unused_data:
+            raise IOError("unexpected end of gzip data")
+
+    def read(self, n=-1):
+        chunks = [self.buf]
+        have = len(self.buf)
+        while n < 0 or have < n:
+            data = self.dobj.unconsumed_tail or self.pending
+            self.pending = ""
+            if not data:
+                data = self.f.read(min(self.left, BLOCK_READ_SIZE))
+                self.left -= len(data)
+                if not data:
+                    self.__check_end()
+                    break
+            s = self.dobj.decompress(data, BLOCK_READ_SIZE)
+            if self.dobj.unused_data:
+                # start of the next member
+                self.pending = self.dobj.unused_data
+                self.dobj = zlib.decompressobj(16+zlib.MAX_WBITS)
+            chunks.append(s)
+            have += len(s)
+        s = "".join(chunks)
+        if n < 0:
+            self.buf = ""
+            return s
+        self.buf = s[n:]
+        return s[:n]
+
+class BZ2Reader:
+    """File-like object reading the decompressed content of a bz2
+    file, raising an exception if the file ends within the stream.
+    """
+
+    def __init__(self, path):
+        self.f = open(path, "rb")
+        self.dobj = bz2.BZ2Decompressor()
+        self.buf = ""
+
+    def close(self):
+        self.f.close()
+
+    def read(self, n=-1):
+        chunks = [self.buf]
+        have = len(self.buf)
+        while n < 0 or have < n:
+            data = self.f.read(BLOCK_READ_SIZE)
+            try:
+                s = self.dobj.decompress(data)
+            except EOFError:
+                # past the end of the stream
+                break
+            if not data:
+                raise IOError("unexpected end of bz2 data")
+            chunks.append(s)
+            have += len(s)
+        s = "".join(chunks)
+        if n < 0:
+            self.buf = ""
+            return s
+        self.buf = s[n:]
+        return s[:n]
+
+def get_gzip_member(s, level):
+    """Return s compressed as a gzip member.
+    """
+    f = StringIO.StringIO()
+    w = GzipMemberWriter(f, level)
+    w.write(s)
+    w.close()
+    return f.getvalue()
+
+class ParallelGzipWriter:
+    """File-like object writing to a file as a multi-member gzip
+    file, each member a chunk of chunksize bytes compressed by one
+    of jobs threads (zlib releases the GIL while compressing).
+    """
+
+    def __init__(self, f, level, jobs, chunksize=PARALLEL_CHUNK_SIZE):
+        self.f = f
+        self.level = level
+        self.chunksize = chunksize
+        self.pool = ThreadPool(jobs)
+        # bound memory use to a few chunks per thread
+        self.maxpending = 2*jobs
+        self.pending = []
+        self.chunks = []
+        self.chunklen = 0
+        self.size = 0
+
+    def __submit(self, s):
+        self.pending.append(self.pool.apply_async(get_gzip_member, (s, self.level)))
+        while len(self.pending) > self.maxpending:
+            self.f.write(self.pending.pop(0).get())
+
+    def tell(self):
+        return self.size
+
+    def write(self, s):
+        self.size += len(s)
+        self.chunks.append(s)
+        self.chunklen += len(s)
+        if self.chunklen >= self.chunksize:
+            s = "".join(self.chunks)
+            while len(s) >= self.chunksize:
+                self.__submit(s[:self.chunksize])
+                s = s[self.chunksize:]
+            self.chunks = [s]
+            self.chunklen = len(s)
+
+    def close(self):
+        try:
+            if self.chunklen:
+                self.__submit("".join(self.chunks))
+                self.chunks = []
+                self.chunklen = 0
+            while self.pending:
+                self.f.write(self.pending.pop(0).get())
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+class CompressTarFile(tarfile.TarFile):
+    """Write-only TarFile compressed with a codec (see CODECS). With
+    more than one job, gzip compression is done in parallel (see
+    ParallelGzipWriter).
+    """
+
+    def __init__(self, path, codec="gzip", level=None, jobs=1):
+        self.out = open(path, "wb")
+        if level == None:
+            level = CODECS[codec][1]
+        if codec == "gzip" and jobs > 1:
+            self.writer = ParallelGzipWriter(self.out, level, jobs)
+        elif codec == "gzip":
+            self.writer = GzipMemberWriter(self.out, level)
+        elif codec == "bz2":
+            self.writer = CompressorWriter(self.out, bz2.BZ2Compressor(level))
+        elif codec == "none":
+            self.writer = CompressorWriter(self.out)
+        else:
+            self.writer = CommandWriter(self.out, (CODECS[codec][3] % (level,)).split())
+        tarfile.TarFile.__init__(self, fileobj=self.writer, mode="w")
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            tarfile.TarFile.close(self)
+            self.writer.close()
+        finally:
+            self.out.close()
+
+class BlockTarFile(tarfile.TarFile):
+    """Write-only TarFile producing a blocked package file (see
+    BLOCK_SIZE).
+    """
+
+    def __init__(self, path, blocksize=BLOCK_SIZE, compresslevel=CODECS["gzip"][1]):
+        tarfile.TarFile.__init__(self, fileobj=StringIO.StringIO(), mode="w")
+        self.out = open(path, "wb")
+        self.blocksize = blocksize
+        self.compresslevel = compresslevel
+        self.head = StringIO.StringIO()
+        self.body = None
+        self.tail = StringIO.StringIO()
+        self.blocks = {"head": [], "body": [], "tail": []}
+
+    def addfile(self, tarinfo, fileobj=None):
+        if tarinfo.isdir():
+            self.fileobj = self.head
+        elif tarinfo.isreg():
+            if self.body == None:
+                self.body = GzipMemberWriter(self.out, self.compresslevel)
+            self.fileobj = self.body
+        else:
+            self.fileobj = self.tail
+        tarfile.TarFile.addfile(self, tarinfo, fileobj)
+        if self.body and self.body.size >= self.blocksize:
+            self.blocks["body"].append(self.body.close())
+            self.body = None
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.body:
+                self.blocks["body"].append(self.body.close())
+            for name in ["head", "tail"]:
+                s = getattr(self, name).getvalue()
+                if s:
+                    w = GzipMemberWriter(self.out, self.compresslevel)
+                    w.write(s)
+                    self.blocks[name].append(w.close())
+            w = GzipMemberWriter(self.out, self.compresslevel)
+            w.write(tarfile.NUL*(tarfile.BLOCKSIZE*2))
+            w.write(json.dumps({"version": 1, "blocks": self.blocks}))
+            offset, _ = w.close()
+            self.out.write(get_block_trailer(offset))
+        finally:
+            self.out.close()
+
+def set_dir_attrs(member, path):
+    """Set the owner (if root), mtime and mode of an extracted
+    directory member, as done by TarFile.extract(): the owner by name
+    if known, otherwise by id.
+    """
+    if os.geteuid() == 0:
+        try:
+            gid = grp.getgrnam(member.gname).gr_gid
+        except KeyError:
+            gid = member.gid
+        try:
+            uid = pwd.getpwnam(member.uname).pw_uid
+        except KeyError:
+            uid = member.uid
+        os.chown(path, uid, gid)
+    os.utime(path, (member.mtime, member.mtime))
+    os.chmod(path, member.mode)
+
 class PackageFile:
 
     def __init__(self, path):
@@ -46,34 +559,235 @@ class PackageFile:
     def exists(self):
         return os.path.exists(self.path)
 
+    def __check_members(self, tarf, allowed=None, links=None):
+        """Yield the members of a tar file opened in stream mode,
+        raising an exception at the first member which is not under
+        the package directory or is not safe to extract, or for which
+        allowed(member) is false. links maps the names of the links
+        checked so far to their type; the same one is given for all
+        blocks of a blocked package file.
+        """
+        prefix = self.name+"/"
+        if links == None:
+            links = {}
+
+        def is_under_symlink(path):
+            while path:
+                if links.get(path) == tarfile.SYMTYPE:
+                    return True
+                path = os.path.dirname(path)
+            return False
+
+        for member in tarf:
+            if allowed and not allowed(member):
+                raise Exception("member (%s) not allowed in block" % (member.name,))
+            name = member.name.rstrip("/")
+            if name != self.name and not name.startswith(prefix):
+                raise Exception("member (%s) not under package directory" % (member.name,))
+            if os.path.isabs(name) or ".." in name.split("/"):
+                raise Exception("member (%s) has unsafe path" % (member.name,))
+            if member.ischr() or member.isblk() or member.isfifo():
+                raise Exception("member (%s) is a special file" % (member.name,))
+            # nothing may be written through a link extracted earlier,
+            # nor hard linked to a symlink or through one
+            if name in links:
+                raise Exception("member (%s) replaces a link" % (member.name,))
+            if is_under_symlink(os.path.dirname(name)):
+                raise Exception("member (%s) is under a symlink" % (member.name,))
+            if member.islnk():
+                linkname = os.path.normpath(member.linkname)
+                if not linkname.startswith(prefix) or ".." in linkname.split("/"):
+                    raise Exception("member (%s) hard links outside package directory" % (member.name,))
+                if is_under_symlink(linkname):
+                    raise Exception("member (%s) hard links through a symlink" % (member.name,))
+            if member.issym() or member.islnk():
+                links[name] = member.type
+            yield member
+
+    def __get_block_index(self):
+        """Return the block index of a blocked package file, or None
+        if the package file is a plain tar stream.
+        """
+        f = open(self.path, "rb")
+        try:
+            f.seek(0, os.SEEK_END)
+            if f.tell() < BLOCK_TRAILER_SIZE:
+                return None
+            f.seek(-BLOCK_TRAILER_SIZE, os.SEEK_END)
+            trailer = f.read(BLOCK_TRAILER_SIZE)
+            if trailer[:3] != "\x1f\x8b\x08" or trailer[12:16] != BLOCK_INDEX_ID+struct.pack("<H", 8):
+                return None
+            offset = struct.unpack("<Q", trailer[16:24])[0]
+            reader = GzipReader(self.path, offset, f.tell()-BLOCK_TRAILER_SIZE-offset)
+            try:
+                index = json.loads(reader.read()[tarfile.BLOCKSIZE*2:])
+            finally:
+                reader.close()
+            if index.get("version") != 1:
+                raise Exception("unknown block index version (%s)" % (index.get("version"),))
+            return index
+        finally:
+            f.close()
+
+    def __open_blocks(self, blocks):
+        """Yield each block of the list opened as a stream tar file.
+        """
+        for offset, size in blocks:
+            reader = GzipReader(self.path, offset, size)
+            try:
+                tarf = tarfile.open(fileobj=reader, mode="r|", tarinfo=StreamTarInfo)
+                try:
+                    yield tarf
+                finally:
+                    tarf.close()
+            finally:
+                reader.close()
+
+    def __extract_block(self, tarf, path, allowed, dirs, links=None):
+        """Check and extract the members of a block, then the end of
+        the block. Directory attributes are set afterwards (by the
+        caller), as done by extractall().
+        """
+        for member in self.__check_members(tarf, allowed, links):
+            dirname = os.path.dirname(os.path.join(path, member.name))
+            try:
+                # body blocks may race to create common parents
+                os.makedirs(dirname)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            if member.isdir():
+                dirs.append(member)
+                member = copy.copy(member)
+                member.mode = 0700
+            tarf.extract(member, path)
+        finish_tar_stream(tarf, marker=False)
+
+    def __unpack_blocked(self, path, index, jobs):
+        """Extract a blocked package file: the head block, then the
+        body blocks in parallel, then the tail block.
+        """
+        blocks = index["blocks"]
+        dirs = []
+        links = {}
+        isdirorreg = lambda member: member.isdir() or member.isreg()
+        isreg = lambda member: member.isreg()
+        for tarf in self.__open_blocks(blocks["head"]):
+            self.__extract_block(tarf, path, isdirorreg, dirs, links)
+
+        def extract_body(block):
+            for tarf in self.__open_blocks([block]):
+                self.__extract_block(tarf, path, isreg, [])
+        misc.pmap(extract_body, blocks["body"], jobs)
+
+        # links only come from the tail blocks, extracted last
+        for tarf in self.__open_blocks(blocks["tail"]):
+            self.__extract_block(tarf, path, None, dirs, links)
+
+        # deepest first, as done by extractall()
+        dirs.sort(key=lambda member: member.name, reverse=True)
+        for member in dirs:
+            set_dir_attrs(member, os.path.join(path, member.name))
+
+    def get_control(self):
+        """Return the control of the package file. ssm makepkg puts
+        control.json first, so only the first member is read; other
+        package files are scanned for it.
+        """
+        name = os.path.join(self.name, ".ssm.d/control.json")
+        s = read_member(self.path, name, first=True)
+        if s == None:
+            s = read_member(self.path, name)
+        control = Control()
+        if s != None:
+            control.loads(s)
+        return control
+
+    def is_blocked(self):
+        """Return True if the package file is blocked (see
+        BlockTarFile).
+        """
+        try:
+            return self.__get_block_index() != None
+        except:
+            return False
+
     def is_valid(self):
         try:
             tarf = None
-            tarf = tarfile.open(self.path)
-            for member in tarf.getnames():
-                if not member.startswith(self.name):
-                    return False
+            index = self.__get_block_index()
+            if index:
+                blocks = index["blocks"]
+                isdirorreg = lambda member: member.isdir() or member.isreg()
+                isreg = lambda member: member.isreg()
+                links = {}
+                for names, allowed in [("head", isdirorreg), ("body", isreg), ("tail", None)]:
+                    for _tarf in self.__open_blocks(blocks[names]):
+                        for member in self.__check_members(_tarf, allowed, links):
+                            pass
+                        finish_tar_stream(_tarf, marker=False)
+                return True
+            tarf = open_tar_stream(self.path)
+            for member in self.__check_members(tarf):
+                pass
+            finish_tar_stream(tarf)
+            tarf.close()
+            tarf = None
         except:
             if globls.debug:
                 traceback.print_exc()
             return False
         finally:
             if tarf:
-                tarf.close()
+                try:
+                    tarf.close()
+                except:
+                    pass
         return True
 
-    def unpack(self, dstpath):
+    def unpack(self, dstpath, jobs=1):
+        """Check and extract the package file in a single pass. The
+        package directory is extracted under a temporary name and
+        renamed into place (replacing an existing one) only once all
+        members have been checked, so a bad package file leaves
+        nothing behind. The body blocks of a blocked package file are
+        extracted using up to jobs threads.
+        """
+        tmppath = None
         try:
             tarf = None
-            tarf = tarfile.open(self.path)
-            tarf.extractall(dstpath)
+            tmppath = tempfile.mkdtemp(prefix=".%s-" % (self.name,), dir=dstpath)
+            index = self.__get_block_index()
+            if index:
+                self.__unpack_blocked(tmppath, index, jobs)
+            else:
+                tarf = open_tar_stream(self.path)
+                tarf.extractall(tmppath, self.__check_members(tarf))
+                finish_tar_stream(tarf)
+                tarf.close()
+                tarf = None
+
+            pkgpath = os.path.join(dstpath, self.name)
+            if not os.path.isdir(os.path.join(tmppath, self.name)):
+                raise Exception("missing package directory")
+            if os.path.exists(pkgpath):
+                misc.rename(pkgpath, os.path.join(tmppath, ".old"))
+            misc.rename(os.path.join(tmppath, self.name), pkgpath)
         except:
             if globls.debug:
                 traceback.print_exc()
-            return Error("could not unpack package file")
+            return Error("could not unpack package file (%s)" % (sys.exc_value,))
         finally:
             if tarf:
-                tarf.close()
+                try:
+                    tarf.close()
+                except:
+                    pass
+            if tmppath:
+                try:
+                    misc.rmtree(tmppath)
+                except:
+                    pass
 
         try:
             # upgrade legacy control file (if necessary)
@@ -88,7 +802,7 @@ class PackageFile:
                 if ct[0] != ft[0]:
                     return Error("bad control file name mismatch (%s, %s)" % (ct[0], ft[0]))
                 if ct[1] != ft[1]:
-                    return Error("bad control file version mismatch (%s, %s)" % (t[1], ft[1]))
+                    return Error("bad control file version mismatch (%s, %s)" % (ct[1], ft[1]))
                 if ct[2] != ft[2]:
                     return Error("bad control file platform mismatch (%s, %s)" % (ct[2], ft[2]))
 
@@ -110,7 +824,7 @@ class PackageFileSkeleton(PackageFile):
     def is_valid(self):
         return True
 
-    def unpack(self, dstpath):
+    def unpack(self, dstpath, jobs=1):
         try:
             pkg = Package(os.path.join(dstpath, self.name))
 
@@ -131,3 +845,68 @@ class PackageFileSkeleton(PackageFile):
             if globls.debug:
                 traceback.print_exc()
             return Error("could not unpack skeleton package file")
+
+def benchmark(srcdir, specs=None, jobs=1):
+    """Time packing a directory into a package file, and unpacking
+    it, with each codec (see parse_codec()) available; gzip is also
+    timed with parallel compression if jobs > 1. Throughput is of the
+    uncompressed (tar) size.
+    """
+    import shutil
+    import time
+
+    specs = specs or ["none", "gzip:1", "gzip:6", "gzip:9", "bz2:9", "xz:6", "zstd:3", "lz4:1"]
+    pkgname = "bench_1.0_all"
+    s = json.dumps({"name": "bench", "version": "1.0", "platform": "all"})
+    tmpdir = tempfile.mkdtemp()
+    try:
+        runs = []
+        for spec in specs:
+            try:
+                codec, level = parse_codec(spec)
+            except:
+                print "%-10s %s" % (spec, sys.exc_value)
+                continue
+            runs.append((spec, codec, level, 1))
+            if codec == "gzip" and jobs > 1:
+                runs.append(("%s x%s" % (spec, jobs), codec, level, jobs))
+
+        for label, codec, level, _jobs in runs:
+            path = os.path.join(tmpdir, label.replace(":", "").replace(" ", ""), "%s.ssm" % (pkgname,))
+            os.makedirs(os.path.dirname(path))
+
+            t0 = time.time()
+            tf = CompressTarFile(path, codec, level, _jobs)
+            ti = tarfile.TarInfo(os.path.join(pkgname, ".ssm.d/control.json"))
+            ti.size = len(s)
+            tf.addfile(ti, StringIO.StringIO(s))
+            tf.add(srcdir, pkgname)
+            size = tf.offset
+            tf.close()
+            tpack = time.time()-t0
+
+            dstpath = os.path.join(tmpdir, "unpack")
+            os.makedirs(dstpath)
+            t0 = time.time()
+            err = PackageFile(path).unpack(dstpath)
+            tunpack = time.time()-t0
+            if is_error(err):
+                print "%-10s %s" % (label, err)
+            shutil.rmtree(dstpath)
+            mb = size/1e6
+            print "%-10s pack %7.1f MB/s  unpack %7.1f MB/s  ratio %5.3f  (%.1f MB)" \
+                % (label, mb/tpack, mb/tunpack, os.path.getsize(path)/float(size), os.path.getsize(path)/1e6)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    jobs = 1
+    if args[-2:-1] == ["--jobs"]:
+        jobs = int(args.pop())
+        args.pop()
+    if args[:1] == ["--benchmark"] and len(args) in [2, 3]:
+        benchmark(args[1], args[2:] and args[2].split(",") or None, jobs)
+    else:
+        sys.stderr.write("usage: packagefile.py --benchmark <dir> [<codec>[:<level>],...] [--jobs <n>]\n")
+        sys.exit(1)
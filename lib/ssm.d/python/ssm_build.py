@@ -28,7 +28,6 @@ import json
 import os.path
 import sys
 from sys import stderr
-import tarfile
 import traceback
 
 from pyerrors.errors import Error, is_error
@@ -38,7 +37,7 @@ from ssm.builder import Builder
 from ssm.deps import DependencyManager
 from ssm.domain import Domain
 from ssm.misc import exits
-from ssm.packagefile import PackageFile
+from ssm.packagefile import PackageFile, read_member
 
 def load_builders(workdir, bssmdir, sourcesurl, dompath, repourl, buildnames, platform, initfile, initpkg):
     name2bssmpath = {}
@@ -54,9 +53,7 @@ def load_builders(workdir, bssmdir, sourcesurl, dompath, repourl, buildnames, pl
         if globls.verbose:
             print "loadings bssm file (%s)" % (bssmpath,)
         try:
-            tarf = tarfile.open(bssmpath)
-            s = tarf.extractfile("bcontrol.json").read()
-            bcontrol = json.loads(s)
+            bcontrol = json.loads(read_member(bssmpath, "bcontrol.json"))
         except:
             raise Exception("cannot load file (%s)" % (bssmpath,))
         name2bssmpath[bcontrol["name"]] = bssmpath
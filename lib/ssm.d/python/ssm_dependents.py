@@ -0,0 +1,118 @@
+#! /usr/bin/env python2
+#
+# ssm_dependents.py
+
+# GPL--start
+# This file is part of ssm (Simple Software Manager)
+# Copyright (C) 2005-2012 Environment/Environnement Canada
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Provides the dependents subcommand.
+"""
+
+import os
+import os.path
+import sys
+from sys import stderr
+import traceback
+
+from pyerrors.errors import Error, is_error
+
+from ssm import globls
+from ssm.domain import Domain
+from ssm.misc import exits
+from ssm.package import Package
+
+def print_usage():
+    print("""\
+usage: ssm dependents [<options>] -d <dompath> -pp <platform> <name> ...
+       ssm dependents -h|--help
+
+Show the published packages which depend, directly or indirectly,
+on the named packages: those which would break if the named
+packages were unpublished.
+
+Where:
+<dompath>       Domain path.
+<platform>      Platform of the published packages.
+<name>          Package name or short name (e.g., hdf5).
+
+Options:
+--direct        Show only the packages depending directly on the
+                named packages.
+
+--debug         Enable debugging.
+--verbose       Enable verbose output.""")
+
+def run(args):
+    try:
+        dompath = None
+        names = None
+        pubplat = None
+        indirect = True
+
+        while args:
+            arg = args.pop(0)
+            if arg == "-d" and args:
+                dompath = args.pop(0)
+            elif arg == "--direct":
+                indirect = False
+            elif arg == "-pp" and args:
+                pubplat = args.pop(0)
+
+            elif arg in ["-h", "--help"]:
+                print_usage()
+                sys.exit(0)
+            elif arg == "--debug":
+                globls.debug = True
+            elif arg == "--verbose":
+                globls.verbose = True
+            else:
+                names = [arg]+args
+                del args[:]
+
+        if not dompath or not pubplat or not names:
+            raise Exception()
+    except SystemExit:
+        raise
+    except:
+        if globls.debug:
+            traceback.print_exc()
+        exits("error: bad/missing arguments")
+
+    try:
+        dom = Domain(dompath)
+        if not dom.exists():
+            exits("error: cannot find domain (%s)" % (dompath,))
+        meta = dom.get_meta()
+        if meta.get("version") == None:
+            exits("error: old domain not supported; you may want to upgrade")
+
+        shorts = [("_" in name) and Package(name).short or name for name in names]
+        pkgshorts = err = dom.get_requiredby(shorts, pubplat, indirect)
+        if is_error(err):
+            exits(err)
+        index = dom.get_index()
+        for pkgshort in pkgshorts:
+            print index.get_published_short(pubplat, pkgshort) or pkgshort
+    except SystemExit:
+        raise
+    except:
+        if globls.debug:
+            traceback.print_exc()
+        exits("error: operation failed")
+    sys.exit(0)
@@ -40,13 +40,13 @@ usage: ssm <cmd> [<args>]
 Simple Software Manager.
 
 List operations:
-    ssm diffd|invd|listd [<args>]
+    ssm dependents|diffd|invd|listd|which [<args>]
 
 Package management:
     ssm install|publish|uninstall|unpublish [<args>]
         
 Domain management:
-    ssm cloned|created|upgraded [<args>]
+    ssm cloned|created|gend|upgraded [<args>]
 
 Other:
     ssm makepkg [<args>]
@@ -74,6 +74,9 @@ if __name__ == "__main__":
     elif cmd == "cloned":
         import ssm_cloned
         ssm_cloned.run(args)
+    elif cmd == "dependents":
+        import ssm_dependents
+        ssm_dependents.run(args)
     elif cmd == "diffd":
         import ssm_diffd
         ssm_diffd.run(args)
@@ -111,6 +114,9 @@ if __name__ == "__main__":
     elif cmd == "created":
         import ssm_created
         ssm_created.run(args)
+    elif cmd == "gend":
+        import ssm_gend
+        ssm_gend.run(args)
     elif cmd == "freezed":
         print("NIY")
     elif cmd == "showd":
@@ -122,6 +128,9 @@ if __name__ == "__main__":
     elif cmd == "upgraded":
         import ssm_upgraded
         ssm_upgraded.run(args)
+    elif cmd == "which":
+        import ssm_which
+        ssm_which.run(args)
     elif cmd == "version":
         from ssm import constants
         print(constants.SSM_VERSION)
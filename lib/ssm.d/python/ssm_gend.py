@@ -0,0 +1,144 @@
+#! /usr/bin/env python2
+#
+# ssm_gend.py
+
+# GPL--start
+# This file is part of ssm (Simple Software Manager)
+# Copyright (C) 2005-2012 Environment/Environnement Canada
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Provides the gend subcommand.
+"""
+
+import os.path
+import sys
+from sys import stderr
+import traceback
+
+from pyerrors.errors import Error, is_error
+
+from ssm import constants
+from ssm import globls
+from ssm.domain import Domain
+from ssm.misc import exits
+
+def print_usage():
+    print("""\
+usage: ssm gend [<options>] -d <dompath> -pp <platform> (--enable|--list|--rollback)
+       ssm gend -h|--help
+
+Manage the publish generations of a platform. With generations, each
+publish, unpublish or upgrade builds a new generation of the platform
+tree which is then made current in a single step. The last generations
+are kept for rollback.
+
+Where:
+<dompath>       Domain path.
+<platform>      Platform.
+
+Options:
+--enable        Enable generations for the platform. The existing
+                platform tree becomes generation 1.
+-g <gen>        Generation to rollback to. Default is the one
+                preceding the current generation.
+--keep <n>      Number of generations to keep for the domain. Default
+                is %s.
+--list          List generations. The current one is marked with *.
+--rollback      Make an earlier generation current.
+
+--debug         Enable debugging.
+--force         Force operation.
+--verbose       Enable verbose output.""" % (constants.GENERATIONS_KEEP,))
+
+def run(args):
+    try:
+        action = None
+        dompath = None
+        generation = None
+        keep = None
+        pubplat = None
+
+        while args:
+            arg = args.pop(0)
+            if arg == "-d" and args:
+                dompath = args.pop(0)
+            elif arg == "--enable":
+                action = "enable"
+            elif arg == "-g" and args:
+                generation = int(args.pop(0))
+            elif arg == "--keep" and args:
+                keep = int(args.pop(0))
+            elif arg == "--list":
+                action = "list"
+            elif arg == "-pp" and args:
+                pubplat = args.pop(0)
+            elif arg == "--rollback":
+                action = "rollback"
+
+            elif arg in ["-h", "--help"]:
+                print_usage()
+                sys.exit(0)
+            elif arg == "--debug":
+                globls.debug = True
+            elif arg == "--force":
+                globls.force = True
+            elif arg == "--verbose":
+                globls.verbose = True
+            else:
+                raise Exception()
+
+        if not dompath or not pubplat or (not action and keep == None) \
+            or (keep != None and keep < 1):
+            raise Exception()
+    except SystemExit:
+        raise
+    except:
+        if globls.debug:
+            traceback.print_exc()
+        exits("error: bad/missing arguments")
+
+    try:
+        dom = Domain(dompath)
+        if not dom.exists():
+            exits("error: cannot find domain")
+        meta = dom.get_meta()
+        if meta.get("version") == None:
+            exits("error: old domain not supported; you may want to upgrade")
+
+        if keep != None:
+            meta.set("generations", keep)
+            dom.put_meta(meta)
+
+        if action == "enable":
+            err = dom.enable_generations(pubplat)
+            if is_error(err):
+                exits(err)
+        elif action == "list":
+            current = dom.get_current_generation(pubplat)
+            for generation in dom.get_generations(pubplat):
+                print "%s %s" % (generation == current and "*" or " ", generation)
+        elif action == "rollback":
+            err = dom.rollback(pubplat, generation)
+            if is_error(err):
+                exits(err)
+    except SystemExit:
+        raise
+    except:
+        if globls.debug:
+            traceback.print_exc()
+        exits("error: operation failed")
+    sys.exit(0)
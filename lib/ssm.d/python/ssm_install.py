@@ -59,6 +59,8 @@ Where:
 <srcdir>        Source directory from which to install.
 
 Options:
+--jobs <n>      Number of blocks of a blocked package file to unpack
+                in parallel. Default is 1.
 --names <name>[,...]
                 CSV list of top-lvel object names to import.
                 Default is all in the <srcdir>. For use with -s
@@ -76,6 +78,7 @@ Options:
 def run(args):
     try:
         dompath = None
+        jobs = 1
         names = None
         pkgfpath = None
         pkgname = None
@@ -93,6 +96,8 @@ def run(args):
             elif arg == "-f" and args:
                 pkgfpath = args.pop(0)
                 pkgname = None
+            elif arg == "--jobs" and args:
+                jobs = int(args.pop(0))
             elif arg == "--names" and args:
                 names = args.pop(0).split(",")
             elif arg == "-p" and args:
@@ -128,7 +133,8 @@ def run(args):
             dompath, pkgname, _ = split_pkgref(pkgref)
 
         if not dompath \
-            or (not pkgname and not pkgfpath):
+            or (not pkgname and not pkgfpath) \
+            or jobs < 1:
             raise Exception()
     except SystemExit:
         raise
@@ -192,7 +198,7 @@ def run(args):
         if pkgf == None:
             exits("error: cannot find package")
 
-        err = dom.install(pkgf, globls.force, reinstall=reinstall)
+        err = dom.install(pkgf, globls.force, reinstall=reinstall, jobs=jobs)
         if is_error(err):
             exits(err)
     except SystemExit:
@@ -38,7 +38,7 @@ from ssm import misc
 from ssm.control import Control
 from ssm.misc import exits, gid2groupname, uid2username
 from ssm.package import Package
-from ssm.packagefile import PackageFile
+from ssm.packagefile import BlockTarFile, CompressTarFile, PackageFile, parse_codec
 
 def print_usage():
     print("""\
@@ -53,6 +53,17 @@ Where:
 Options:
 --auto-control  Generate minimal control.json. Overrides existing
                 control file information if available.
+--blocked       Make a blocked package file, which can be unpacked
+                in parallel (see ssm install --jobs). It remains a
+                valid tar.gz file.
+--compress <codec>[:<level>]
+                Compress with codec: none, gzip (levels 1-9), bz2
+                (1-9), xz (0-9), zstd (1-19) or lz4 (1-12); xz, zstd
+                and lz4 need their programs. Default is gzip:9.
+                Blocked package files are gzip only.
+--jobs <n>      Number of threads compressing a gzip package file
+                in parallel, in chunks written as a multi-member
+                gzip file. Default is 1.
 -p <pkgname>    Use an alternate package name. Implies
                 --auto-control.
 
@@ -63,6 +74,9 @@ Options:
 def run(args):
     try:
         autocontrol = False
+        blocked = False
+        compress = "gzip"
+        jobs = 1
         srcdir = None
         pkgname = None
 
@@ -70,6 +84,12 @@ def run(args):
             arg = args.pop(0)
             if arg == "--auto-control":
                 autocontrol = True
+            elif arg == "--blocked":
+                blocked = True
+            elif arg == "--compress" and args:
+                compress = args.pop(0)
+            elif arg == "--jobs" and args:
+                jobs = int(args.pop(0))
             elif arg == "-p" and args:
                 pkgname = args.pop(0)
                 autocontrol = True
@@ -88,7 +108,7 @@ def run(args):
             else:
                 srcdir = arg
 
-        if srcdir == None:
+        if srcdir == None or jobs < 1:
             raise Exception()
     except SystemExit:
         raise
@@ -105,6 +125,15 @@ def run(args):
         if not pkgname:
             pkgname = pkg.name
 
+        try:
+            codec, level = parse_codec(compress)
+        except:
+            exits("error: %s" % (sys.exc_value,))
+        if blocked and codec != "gzip":
+            exits("error: blocked package files must use gzip")
+        if jobs > 1 and (blocked or codec != "gzip"):
+            exits("error: parallel compression is for gzip, non-blocked package files only")
+
         pkgname_comps = pkgname.split("_")
         if len(pkgname_comps) != 3:
             exits("error: bad package name (%s)" % (pkgname,))
@@ -143,10 +172,14 @@ def run(args):
                 return ti.name not in excluded and ti or None
 
             pkgf = PackageFile("%s.ssm" % (pkgname,))
-            tf = tarfile.open(pkgf.path, "w|gz")
-            tf.add(srcdir, pkgname, recursive=True, filter=filefilter)
+            if blocked:
+                tf = BlockTarFile(pkgf.path, compresslevel=level)
+            else:
+                tf = CompressTarFile(pkgf.path, codec, level, jobs)
 
-            # special case for control.json
+            # special case for control.json, first so that it can be
+            # read without reading the rest (see
+            # PackageFile.get_control())
             ti = tarfile.TarInfo()
             ti.name = control_path_short
             ti.mode = 0644
@@ -160,6 +193,7 @@ def run(args):
             ti.size = len(s)
             tf.addfile(ti, f)
 
+            tf.add(srcdir, pkgname, recursive=True, filter=filefilter)
             tf.close()
         except:
             if pkgf.exists():
@@ -40,17 +40,35 @@ from ssm.package import determine_platform, split_pkgref
 def print_usage():
     print("""\
 usage: ssm publish [<options>] (-d <dompath> -p <pkgname> | -x <pkgref>)
+       ssm publish [<options>] -d <dompath> (-p <pkgname>[,...] | --file <path>) ...
        ssm publish -h|--help
 
-Publish package to domain.
+Publish package to domain. If another version of the package is
+published, it is replaced in place: only the links which differ are
+changed and dependent packages stay published.
+
+Several packages, given by repeated or comma-separated -p options,
+or listed in a file, are checked together and published in dependency
+order. All must publish to the same platform.
+
+With several platforms, the package is walked once and published to
+each platform in turn.
 
 Where:
 <dompath>       Domain path.
+<path>          File listing package names, one per line.
 <pkgname>       Package name.
 <pkgref>        Package reference for domain and package.
 
 Options:
--pp <platform>  Alternate platform to publish to. Default is the
+--dry           Dry run. Show the directories and links that would be
+                created, and their counts.
+--fold          Link directories not shared with other packages
+                rather than each file in them. Folded directories are
+                unfolded as needed when other packages are published.
+--jobs <n>      Number of links to make in parallel. Default is 1.
+-pp <platform>[,...]
+                Alternate platform(s) to publish to. Default is the
                 package platform or SSMUSE_PLATFORM.
 -P <dompath>    Alternate domain to publish to.
 
@@ -58,12 +76,90 @@ Options:
 --force         Force operation.
 --verbose       Enable verbose output.""")
 
+def print_plan(pubdom, pkg, pubplat, fold, tree=None):
+    manifest = pubdom.get_publish_plan(pkg, pubplat, fold, None, tree)
+    pubplatpath = pubdom.joinpath(pubplat)
+    for relpath in manifest.unfolds:
+        print "unfold %s" % (os.path.join(pubplatpath, relpath),)
+    for relpath in manifest.get("dirs"):
+        print "mkdir %s" % (os.path.join(pubplatpath, relpath),)
+    for relpath in manifest.get("links"):
+        print "symlink %s %s" % (manifest.get_target(relpath), os.path.join(pubplatpath, relpath))
+    print "plan: %s dirs, %s links" % (len(manifest.get("dirs")), len(manifest.get("links")))
+
+def publish_many(dom, pubdom, pkgnames, pubplats, dry, jobs, fold):
+    pkgs = []
+    for pkgname in pkgnames:
+        pkg = dom.get_installed_package(pkgname)
+        if not pkg:
+            exits("error: package not installed (%s)" % (pkgname,))
+        pkgs.append(pkg)
+
+    if not pubplats:
+        pubplats = set([determine_platform(pkg) for pkg in pkgs])
+        if None in pubplats:
+            exits("error: cannot determine platform")
+        if len(pubplats) > 1:
+            exits("error: packages have different platforms; use -pp")
+        pubplats = list(pubplats)
+
+    for pubplat in pubplats:
+        if dry:
+            orderedpkgs = err = pubdom.get_publish_order(pkgs, pubplat)
+            if is_error(err):
+                exits(err)
+            for pkg in orderedpkgs:
+                print "package %s %s" % (pkg.name, pubplat)
+                print_plan(pubdom, pkg, pubplat, fold)
+            continue
+
+        err = pubdom.publish_many(pkgs, pubplat, globls.force, jobs, fold)
+        if is_error(err):
+            exits(err)
+
+def publish_platforms(pubdom, pkg, pubplats, dry, jobs, fold):
+    if dry:
+        tree = pkg.get_publishable_tree()
+        for pubplat in pubplats:
+            print "platform %s" % (pubplat,)
+            print_plan(pubdom, pkg, pubplat, fold, tree)
+        return
+
+    # check every platform before changing any; upgrade in place
+    # where another version is published
+    upgrades = []
+    _pubplats = []
+    for pubplat in pubplats:
+        pubpkg = pubdom.get_published_package_short(pkg.name, pubplat)
+        if pubpkg and pubpkg.name != pkg.name:
+            err = pubdom.preupgrade(pubpkg, pkg, pubplat)
+            if is_error(err):
+                exits("%s for platform (%s)" % (err, pubplat))
+            upgrades.append((pubpkg, pubplat))
+        else:
+            _pubplats.append(pubplat)
+    err = pubdom.prepublish_platforms(pkg, _pubplats)
+    if is_error(err):
+        exits(err)
+
+    for pubpkg, pubplat in upgrades:
+        err = pubdom.upgrade(pubpkg, pkg, pubplat, globls.force, jobs, fold)
+        if is_error(err):
+            exits("%s for platform (%s)" % (err, pubplat))
+    err = pubdom.publish_platforms(pkg, _pubplats, globls.force, jobs, fold)
+    if is_error(err):
+        exits(err)
+
 def run(args):
     try:
         dompath = None
+        dry = False
+        fold = False
+        jobs = 1
         pkgname = None
+        pkgnames = []
         pkgref = None
-        pubplat = None
+        pubplats = None
         pubdompath = None
 
         while args:
@@ -71,17 +167,29 @@ def run(args):
             if arg == "-d" and args:
                 dompath = args.pop(0)
                 pkgref = None
+            elif arg == "--dry":
+                dry = True
+            elif arg == "--file" and args:
+                for line in open(args.pop(0)):
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        pkgnames.append(line)
+                pkgref = None
+            elif arg == "--fold":
+                fold = True
+            elif arg == "--jobs" and args:
+                jobs = int(args.pop(0))
             elif arg == "-p" and args:
-                pkgname = args.pop(0)
+                pkgnames.extend(filter(None, args.pop(0).split(",")))
                 pkgref = None
             elif arg == "-pp" and args:
-                pubplat = args.pop(0)
+                pubplats = filter(None, args.pop(0).split(","))
             elif arg == "-P" and args:
                 pubdompath = args.pop(0)
             elif arg == "-x" and args:
                 pkgref = args.pop(0)
                 dompath = None
-                pkgname = None
+                pkgnames = []
 
             elif arg in ["-h", "--help"]:
                 print_usage()
@@ -97,8 +205,9 @@ def run(args):
 
         if pkgref:
             dompath, pkgname, _ = split_pkgref(pkgref)
+            pkgnames = [pkgname]
 
-        if not dompath or not pkgname:
+        if not dompath or not pkgnames or jobs < 1:
             raise Exception()
 
         if not pubdompath:
@@ -125,33 +234,50 @@ def run(args):
         if pubmeta.get("version") == None:
             exits("error: old domain not supported; you may want to upgrade")
 
+        if len(pkgnames) > 1:
+            publish_many(dom, pubdom, pkgnames, pubplats, dry, jobs, fold)
+            sys.exit(0)
+
+        pkgname = pkgnames[0]
         pkg = dom.get_installed_package(pkgname)
         if not pkg:
             exits("error: package not installed")
 
-        pubplat = pubplat or determine_platform(pkg)
+        if pubplats and len(pubplats) > 1:
+            publish_platforms(pubdom, pkg, pubplats, dry, jobs, fold)
+            sys.exit(0)
+
+        pubplat = pubplats and pubplats[0] or determine_platform(pkg)
         if not pubplat:
             exits("error: cannot determine platform")
+        if dry:
+            print_plan(pubdom, pkg, pubplat, fold)
+            sys.exit(0)
+
         pubpkg = pubdom.get_published_package_short(pkg.name, pubplat)
-        if pubpkg:
+        if pubpkg and pubpkg.name != pkg.name:
+            err = pubdom.upgrade(pubpkg, pkg, pubplat, globls.force, jobs, fold)
+            if is_error(err):
+                exits(err)
+            sys.exit(0)
+        elif pubpkg:
             deppkgs = err = pubdom.get_dependents(pubpkg, pubplat)
             if is_error(err):
                 exits(err)
-            if len(deppkgs) > 1 and not globs.force:
+            if len(deppkgs) > 1 and not globls.force:
                 depnames = [deppkg.name for deppkg in deppkgs]
                 print "found dependent packages: %s" % " ".join(depnames)
                 reply = raw_input("unpublish all (y/n)? ")
                 if reply != "y":
                     exits("aborting operation")
-            for deppkg in deppkgs:
-                err = pubdom.unpublish(deppkg, pubplat)
-                if is_error(err):
-                    exits(err)
+            err = pubdom.unpublish_many(deppkgs, pubplat)
+            if is_error(err):
+                exits(err)
 
         err = pubdom.prepublish(pkg, pubplat)
         if is_error(err):
             exits(err)
-        err = pubdom.publish(pkg, pubplat, globls.force)
+        err = pubdom.publish(pkg, pubplat, globls.force, jobs, fold)
         if is_error(err):
             exits(err)
     except SystemExit:
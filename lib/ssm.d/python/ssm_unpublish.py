@@ -39,10 +39,12 @@ from ssm.package import determine_platform, split_pkgref, Package
 
 def print_usage():
     print("""\
-usage: ssm publish [<options>] (-d <dompath> -p <pkgname> | -x <pkgref>)
-       ssm publish -h|--help
+usage: ssm unpublish [<options>] (-d <dompath> -p <pkgname> | -x <pkgref>)
+       ssm unpublish [<options>] -d <dompath> -pp <platform> --all
+       ssm unpublish -h|--help
 
-Unpublish package from domain.
+Unpublish package from domain. With --all, all packages published
+to the platform are unpublished at once by dropping the platform.
 
 Where:
 <dompath>       Domain path.
@@ -50,6 +52,9 @@ Where:
 <pkgref>        Package reference for domain and package.
 
 Options:
+--all           Unpublish all packages of the platform.
+--background    With --all, delete the dropped platform files in the
+                background.
 -pp <platform>  Alternate platform to unpublish from. Default is the
                 package platform or SSMUSE_PLATFORM.
 
@@ -59,6 +64,8 @@ Options:
 
 def run(args):
     try:
+        allpkgs = False
+        background = False
         dompath = None
         pkgname = None
         pkgref = None
@@ -66,7 +73,11 @@ def run(args):
 
         while args:
             arg = args.pop(0)
-            if arg == "-d" and args:
+            if arg == "--all":
+                allpkgs = True
+            elif arg == "--background":
+                background = True
+            elif arg == "-d" and args:
                 dompath = args.pop(0)
                 pkgref = None
             elif arg == "-p" and args:
@@ -96,7 +107,8 @@ def run(args):
         if pkgref:
             dompath, pkgname, _ = split_pkgref(pkgref)
 
-        if not dompath or not pkgname:
+        if not dompath or (not pkgname and not (allpkgs and pubplat)) \
+            or (allpkgs and pkgname):
             raise Exception()
     except SystemExit:
         raise
@@ -113,6 +125,16 @@ def run(args):
         if meta.get("version") == None:
             exits("error: old domain not supported; you may want to upgrade")
 
+        if allpkgs:
+            if not globls.force:
+                reply = raw_input("unpublish all packages of platform (%s) (y/n)? " % (pubplat,))
+                if reply != "y":
+                    exits("aborting operation")
+            err = dom.drop_platform(pubplat, background)
+            if is_error(err):
+                exits(err)
+            sys.exit(0)
+
         pubplat = pubplat or determine_platform(Package(pkgname))
         if not pubplat:
             exits("error: cannot determine platform")
@@ -128,10 +150,9 @@ def run(args):
             reply = raw_input("unpublish all (y/n)? ")
             if reply != "y":
                 exits("aborting operation")
-        for deppkg in deppkgs:
-            err = dom.unpublish(deppkg, pubplat)
-            if is_error(err):
-                exits(err)
+        err = dom.unpublish_many(deppkgs, pubplat)
+        if is_error(err):
+            exits(err)
     except SystemExit:
         raise
     except:
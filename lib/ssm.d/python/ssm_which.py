@@ -0,0 +1,127 @@
+#! /usr/bin/env python2
+#
+# ssm_which.py
+
+# GPL--start
+# This file is part of ssm (Simple Software Manager)
+# Copyright (C) 2005-2012 Environment/Environnement Canada
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Provides the which subcommand.
+"""
+
+import os
+import os.path
+import sys
+from sys import stderr
+import traceback
+
+from pyerrors.errors import Error, is_error
+
+from ssm import globls
+from ssm.domain import Domain
+from ssm.misc import exits
+
+def print_usage():
+    print("""\
+usage: ssm which [<options>] -d <dompath> <path> ...
+       ssm which -h|--help
+
+Show the published package providing each path. A path is either
+absolute (under <dompath>) or relative to <dompath>. With -pp, a
+relative path is taken relative to the platform directory.
+
+Where:
+<dompath>       Domain path.
+<path>          Published path.
+
+Options:
+-pp <platform>  Platform of the relative paths.
+
+--debug         Enable debugging.
+--verbose       Enable verbose output.""")
+
+def run(args):
+    try:
+        dompath = None
+        paths = None
+        pubplat = None
+
+        while args:
+            arg = args.pop(0)
+            if arg == "-d" and args:
+                dompath = args.pop(0)
+            elif arg == "-pp" and args:
+                pubplat = args.pop(0)
+
+            elif arg in ["-h", "--help"]:
+                print_usage()
+                sys.exit(0)
+            elif arg == "--debug":
+                globls.debug = True
+            elif arg == "--verbose":
+                globls.verbose = True
+            else:
+                paths = [arg]+args
+                del args[:]
+
+        if not dompath or not paths:
+            raise Exception()
+    except SystemExit:
+        raise
+    except:
+        if globls.debug:
+            traceback.print_exc()
+        exits("error: bad/missing arguments")
+
+    try:
+        dom = Domain(dompath)
+        if not dom.exists():
+            exits("error: cannot find domain (%s)" % (dompath,))
+        meta = dom.get_meta()
+        if meta.get("version") == None:
+            exits("error: old domain not supported; you may want to upgrade")
+
+        status = 0
+        for path in paths:
+            if pubplat and not os.path.isabs(path):
+                platform, relpath = pubplat, path
+            else:
+                path = os.path.normpath(dom.joinpath(path))
+                for dpath in [dom.path, dom.realpath]:
+                    if path.startswith(dpath+"/"):
+                        relpath = path[len(dpath)+1:]
+                        break
+                else:
+                    stderr.write("error: path (%s) not in domain\n" % (path,))
+                    status = 1
+                    continue
+                platform, _, relpath = relpath.partition("/")
+
+            owner = dom.get_path_owner(relpath, platform)
+            if owner == None:
+                stderr.write("error: path (%s) not published for platform (%s)\n" % (relpath, platform))
+                status = 1
+                continue
+            print "%s %s %s" % (platform, relpath, owner)
+    except SystemExit:
+        raise
+    except:
+        if globls.debug:
+            traceback.print_exc()
+        exits("error: operation failed")
+    sys.exit(status)